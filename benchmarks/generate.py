@@ -0,0 +1,126 @@
+""" A generator of synthetic dialogic logs: request/response pairs of Alice-style and plain sessions """
+import datetime
+import itertools
+import random
+import struct
+import uuid
+
+from bson import ObjectId
+
+HANDLERS = [
+    'hello', 'help', 'fallback', 'weather', 'news', 'quiz_question', 'quiz_answer', 'settings', 'goodbye', 'repeat',
+]
+REQUESTS = [
+    'привет', 'что ты умеешь', 'какая погода завтра', 'расскажи новости', 'давай сыграем', 'не знаю',
+    'повтори пожалуйста', 'хватит', 'включи напоминания', 'а что ещё', 'сколько будет два плюс два',
+    'спасибо большое', 'да', 'нет', 'помощь', 'какой сегодня день',
+]
+RESPONSES = [
+    'Привет! Я умею рассказывать новости и погоду.', 'Завтра будет солнечно, до двадцати градусов.',
+    'Вот главные новости на сегодня.', 'Отлично, первый вопрос.', 'Правильно! Следующий вопрос.',
+    'Я вас не поняла, повторите, пожалуйста.', 'До свидания!', 'Напоминания включены.',
+]
+REQUEST_TYPES = ['SimpleUtterance'] * 9 + ['ButtonPressed']
+
+
+class LogGenerator:
+    """
+    Produce log documents in the format of dialogic: a request (`from_user=True`) and a response
+    sharing one `request_id`. A part of the sessions looks like Alice (the session id is in `data.session`),
+    the rest carries a plain `session_id`. The activity of users is skewed, as in real bots.
+    """
+    def __init__(self, n_users=1000, alice_share=0.7, start=None, seed=0):
+        self.random = random.Random(seed)
+        self.n_users = n_users
+        self.alice_share = alice_share
+        self.start = start or datetime.datetime(2021, 1, 1)
+        self.counter = 0
+        # Zipf-like weights: a few users write most of the messages
+        self.users = [f'user_{i}' for i in range(n_users)]
+        self.user_weights = list(itertools.accumulate(1 / (i + 1) ** 1.1 for i in range(n_users)))
+        self.handler_weights = list(itertools.accumulate(1 / (i + 1) for i in range(len(HANDLERS))))
+
+    def make_id(self, moment: datetime.datetime):
+        # ObjectIds grow with time, as the incremental jobs of the dashboard expect
+        self.counter += 1
+        seconds = int(moment.replace(tzinfo=datetime.timezone.utc).timestamp())
+        return ObjectId(struct.pack('>IQ', seconds, self.counter))
+
+    def pick_user(self):
+        return self.random.choices(self.users, cum_weights=self.user_weights)[0]
+
+    def session(self, moment: datetime.datetime):
+        user_id = self.pick_user()
+        alice = self.random.random() < self.alice_share
+        session_id = str(uuid.UUID(int=self.random.getrandbits(128)))
+        length = min(1 + int(self.random.expovariate(1 / 5)), 50)
+        for message_id in range(length):
+            yield from self.pair(moment, user_id, session_id, message_id, alice)
+            moment += datetime.timedelta(seconds=self.random.randint(2, 60))
+
+    def pair(self, moment, user_id, session_id, message_id, alice):
+        request_id = str(uuid.UUID(int=self.random.getrandbits(128)))
+        text = self.random.choice(REQUESTS)
+        response = self.random.choice(RESPONSES)
+        handler = self.random.choices(HANDLERS, cum_weights=self.handler_weights)[0]
+        request = {
+            '_id': self.make_id(moment),
+            'request_id': request_id,
+            'from_user': True,
+            'timestamp': str(moment),
+            'text': text,
+            'user_id': user_id,
+        }
+        response_time = moment + datetime.timedelta(milliseconds=self.random.randint(50, 900))
+        reply = {
+            '_id': self.make_id(response_time),
+            'request_id': request_id,
+            'from_user': False,
+            'timestamp': str(response_time),
+            'text': response,
+            'user_id': user_id,
+            'handler': handler,
+        }
+        if alice:
+            session = {'session_id': session_id, 'message_id': message_id, 'new': message_id == 0, 'user_id': user_id}
+            request['data'] = {
+                'meta': {'client_id': 'ru.yandex.searchplugin/7.16', 'locale': 'ru-RU'},
+                'request': {'command': text, 'original_utterance': text, 'type': self.random.choice(REQUEST_TYPES)},
+                'session': session,
+                'version': '1.0',
+            }
+            reply['data'] = {
+                'response': {'text': response, 'end_session': False},
+                'session': session,
+                'version': '1.0',
+            }
+        else:
+            request['session_id'] = session_id
+            reply['session_id'] = session_id
+        yield request
+        yield reply
+
+    def generate(self, n_documents, days=90):
+        """ Yield `n_documents` documents of sessions that start one after another over `days` days """
+        n_sessions = max(1, n_documents // 12)
+        step = datetime.timedelta(days=days) / n_sessions
+        moment = self.start
+        produced = 0
+        while produced < n_documents:
+            docs = sorted(self.session(moment), key=lambda d: d['_id'])
+            for doc in docs[:n_documents - produced]:
+                yield doc
+            produced += len(docs)
+            moment += step * self.random.uniform(0.5, 1.5)
+
+
+def load(coll, n_documents, batch_size=10000, **kwargs):
+    """ Fill `coll` with generated logs """
+    batch = []
+    for doc in LogGenerator(**kwargs).generate(n_documents):
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            coll.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        coll.insert_many(batch, ordered=False)
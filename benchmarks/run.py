@@ -0,0 +1,250 @@
+"""
+Time the dashboard queries and pages on generated logs of several sizes, and write a JSON and a Markdown report.
+
+    python -m benchmarks.run --url mongodb://localhost/bench --sizes 10000,100000,1000000
+    python -m benchmarks.run --sizes 10000 --compare bench_report.json
+
+Without --url the logs are loaded into mongomock (pip install mongomock), which is good for a quick check only:
+it does not support all the operators (the jobs and cases that need them are listed as errors in the report)
+and its timings say nothing about a real server.
+"""
+import argparse
+import datetime
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import time
+
+from .generate import load
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_database(url):
+    if url:
+        import pymongo
+        return pymongo.MongoClient(url).get_default_database()
+    import mongomock
+    return mongomock.MongoClient().get_database('bench')
+
+
+def measure(func, repeat):
+    """ Return the time of the first call (it may build the incremental stores) and the median of the next ones """
+    start = time.perf_counter()
+    func()
+    cold = time.perf_counter() - start
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return cold * 1000, statistics.median(times) * 1000 if times else None
+
+
+def keyset_token(items, key):
+    from dialogic_dashboard.dash_app.cursors import encode_cursor
+    return encode_cursor(items[-1][key], items[-1]['_id']) if items else None
+
+
+def make_cases(logs_coll, app, depths, page_size=15):
+    """ The benchmarked calls: (name, function) """
+    from dialogic_dashboard.dash_app import views
+    from dialogic_dashboard.dash_app.rollups import time_series
+
+    cases = [
+        ('find_sessions', lambda: views.find_sessions(logs_coll, page_size=page_size)),
+        ('find_users', lambda: views.find_users(logs_coll, page_size=page_size)),
+        ('find_handlers', lambda: views.find_handlers(logs_coll)),
+        ('time_series messages day', lambda: time_series(logs_coll, 'messages')),
+        ('time_series users day', lambda: time_series(logs_coll, 'users')),
+        ('time_series users week', lambda: time_series(logs_coll, 'users', granularity='week')),
+    ]
+    for depth in depths:
+        if not depth:
+            continue
+        cases.append((f'find_sessions page {depth}', lambda d=depth: views.find_sessions(
+            logs_coll, page=d, page_size=page_size,
+        )))
+        cases.append((f'find_users page {depth}', lambda d=depth: views.find_users(
+            logs_coll, page=d, page_size=page_size,
+        )))
+        # the same depth reached with a keyset cursor, as the "Older" links do
+        previous = views.find_sessions(logs_coll, page=depth - 1, page_size=page_size)
+        token = keyset_token(previous, 'latest')
+        cases.append((f'find_sessions keyset {depth}', lambda t=token: views.find_sessions(
+            logs_coll, page_size=page_size, after=t,
+        )))
+
+    top_user = logs_coll.find_one({'user_id': 'user_0'})
+    session = views.find_sessions(logs_coll, page_size=1)
+    session_id = session[0]['_id'] if session else None
+    if session_id:
+        cases.append(('find_pairs of a session', lambda: views.find_pairs(logs_coll, filters={'session_id': session_id})))
+
+    client = app.test_client()
+    routes = {route: route for route in ['/sessions', '/users', '/handlers', '/api/messages-by-day', '/api/users-by-day']}
+    if top_user:
+        routes['/user/<user_id>'] = '/user/user_0'
+    if session_id:
+        routes['/session/<session_id>'] = f'/session/{session_id}'
+    for label, url in routes.items():
+        cases.append((f'GET {label}', lambda u=url: check_response(client.get(u))))
+    return cases
+
+
+def check_response(response):
+    if response.status_code >= 400:
+        raise RuntimeError(f'HTTP {response.status_code}')
+    return response
+
+
+def make_app(logs_coll):
+    from dialogic_dashboard.dash_app import create_app
+    from dialogic_dashboard.dash_app.app_config import AppConfig
+    from dialogic_dashboard.dash_app.cache import LRUCache, ResultCache
+
+    app = create_app(
+        configs={'bench': {'name': 'bench', 'database_uri': None}}, ensure_indexes=False, build_interval=0,
+    )
+    app.config['LOGIN_DISABLED'] = True
+    # the failed cases are listed in the report
+    app.logger.setLevel(logging.CRITICAL)
+    app.configs = {'bench': AppConfig(id='bench', name='bench', database_uri=None, logs_collection_name=logs_coll.name)}
+    app.logs_map = {'bench': logs_coll}
+    # every call should run its queries
+    app.result_cache = ResultCache(LRUCache(maxsize=0))
+    return app
+
+
+def drop_collections(db, name):
+    for coll_name in db.list_collection_names():
+        if coll_name == name or coll_name.startswith(name + '_'):
+            db.drop_collection(coll_name)
+
+
+def run_size(db, size, depths, repeat, n_users):
+    from dialogic_dashboard.dash_app.app_config import AppConfig
+    from dialogic_dashboard.dash_app.builder import BUILD_BATCH_SIZE, JOBS
+    from dialogic_dashboard.dash_app.indexes import ensure_indexes
+
+    name = f'bench_logs_{size}'
+    drop_collections(db, name)
+    logs_coll = db.get_collection(name)
+    start = time.perf_counter()
+    load(logs_coll, size, n_users=n_users)
+    ensure_indexes(logs_coll, AppConfig(id='bench', name='bench', database_uri=None, logs_collection_name=name))
+    results = [{'size': size, 'name': 'load and index', 'cold_ms': (time.perf_counter() - start) * 1000}]
+    print(f'{size}: loaded in {results[0]["cold_ms"]:.0f} ms')
+    for job in JOBS:
+        # a job that fails (mongomock lacks some operators) is reported, and its store is left to the cases
+        result = {'size': size, 'name': f'build {job.__name__}'}
+        start = time.perf_counter()
+        try:
+            while job(logs_coll, max_size=BUILD_BATCH_SIZE):
+                pass
+            result['cold_ms'] = (time.perf_counter() - start) * 1000
+        except Exception as e:
+            result['error'] = f'{type(e).__name__}: {e}'
+        results.append(result)
+        print(f'{size}: {result["name"]}: {format_result(result)}')
+
+    app = make_app(logs_coll)
+    for case_name, func in make_cases(logs_coll, app, depths):
+        result = {'size': size, 'name': case_name}
+        try:
+            result['cold_ms'], result['warm_ms'] = measure(func, repeat)
+        except Exception as e:
+            result['error'] = f'{type(e).__name__}: {e}'
+        results.append(result)
+        print(f'{size}: {case_name}: {format_result(result)}')
+    drop_collections(db, name)
+    return results
+
+
+def format_result(result):
+    if 'error' in result:
+        return 'error'
+    if result.get('warm_ms') is None:
+        return f'{result["cold_ms"]:.1f}'
+    return f'{result["warm_ms"]:.1f} ({result["cold_ms"]:.1f})'
+
+
+def markdown_report(report, previous=None):
+    sizes = sorted({r['size'] for r in report['results']})
+    names = list(dict.fromkeys(r['name'] for r in report['results']))
+    found = {(r['size'], r['name']): r for r in report['results']}
+    before = {(r['size'], r['name']): r for r in previous['results']} if previous else {}
+    meta = report['meta']
+    lines = [
+        f'# Benchmark {meta["commit"] or ""} on {meta["backend"]}, {meta["date"]}',
+        '',
+        'Median time of repeated calls in ms, the first call in parentheses.'
+        + (f' The ratio to {previous["meta"]["commit"]} follows the time.' if previous else ''),
+        '',
+        '| case | ' + ' | '.join(str(s) for s in sizes) + ' |',
+        '|---|' + '---|' * len(sizes),
+    ]
+    for name in names:
+        cells = []
+        for size in sizes:
+            result = found.get((size, name))
+            cell = format_result(result) if result else ''
+            old = before.get((size, name))
+            if result and old and result.get('warm_ms') and old.get('warm_ms'):
+                cell += f' x{result["warm_ms"] / old["warm_ms"]:.2f}'
+            cells.append(cell)
+        lines.append(f'| {name} | ' + ' | '.join(cells) + ' |')
+    errors = [r for r in report['results'] if 'error' in r]
+    if errors:
+        lines.extend(['', '## Errors', ''])
+        lines.extend(f'- {r["size"]} {r["name"]}: {r["error"]}' for r in errors)
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the dashboard queries on generated logs')
+    parser.add_argument('--url', help='MongoDB connection string with a database; mongomock if omitted', default=None)
+    parser.add_argument('--sizes', help='Comma-separated numbers of log documents', default='10000,100000')
+    parser.add_argument('--depths', help='Comma-separated page numbers to read', default='0,10,100')
+    parser.add_argument('--users', help='Number of distinct users', default=1000, type=int)
+    parser.add_argument('--repeat', help='Timed calls after the first one', default=3, type=int)
+    parser.add_argument('--output', help='Report path without an extension', default='bench_report')
+    parser.add_argument('--compare', help='A previous JSON report to compare with', default=None)
+    args = parser.parse_args()
+
+    db = get_database(args.url)
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'backend': 'mongodb' if args.url else 'mongomock',
+            'date': datetime.datetime.utcnow().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'repeat': args.repeat,
+            'users': args.users,
+        },
+        'results': [],
+    }
+    depths = [int(d) for d in args.depths.split(',') if d]
+    for size in [int(s) for s in args.sizes.split(',') if s]:
+        report['results'].extend(run_size(db, size, depths, args.repeat, args.users))
+
+    previous = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+    with open(args.output + '.json', 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    with open(args.output + '.md', 'w', encoding='utf-8') as f:
+        f.write(markdown_report(report, previous))
+    print(f'The report is written to {args.output}.json and {args.output}.md')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,82 @@
 import argparse
+import json
 import os
+import sys
 
 from .dash_app import create_app
 
 
 def main():
     parser = argparse.ArgumentParser(description='Run LogViewer')
+    parser.add_argument(
+        'command', nargs='?', default='run', choices=['run', 'serve', 'build'],
+        help='"run" starts the development server, "serve" starts a multi-worker production server, '
+             '"build" catches up the incremental stores with the logs and exits',
+    )
     parser.add_argument('--debug', help='Run the app in the debug mode', default=False, action='store_true')
     parser.add_argument('--url', help='The connection string to MongoDB', default=None, type=str)
     parser.add_argument('--collection', help='The collection name in MongoDB', default=None, type=str)
+    parser.add_argument(
+        '--config', help='A json file with the app configs: {"<id>": {"name": ..., "database_uri": ..., ...}}',
+        default=None, type=str,
+    )
+    parser.add_argument(
+        '--check-plans', help='Explain the queries of all views, report collection scans and exit',
+        default=False, action='store_true',
+    )
+    parser.add_argument(
+        '--workers', help='Number of worker processes for "serve"', default=int(os.getenv('WEB_CONCURRENCY', 2)),
+        type=int,
+    )
+    parser.add_argument(
+        '--threads', help='Max concurrent requests per process in the "serve" mode', default=4, type=int,
+    )
+    parser.add_argument(
+        '--query-timeout', help='Time limit for the MongoDB queries of one request, in milliseconds',
+        default=None, type=int,
+    )
     args = parser.parse_args()
-    app = create_app(mongodb_uri=args.url, collection_name=args.collection)
-    app.run('0.0.0.0', port=os.getenv('PORT', 5000), debug=args.debug)
+    configs = None
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            configs = json.load(f)
+    query_timeout = args.query_timeout
+    if query_timeout is None and args.command == 'serve':
+        query_timeout = 30000
+
+    threads = args.threads
+    # each live stream holds a thread, so the streams may take at most half of the threads of a process
+    live_max_streams = int(os.getenv('LIVE_MAX_STREAMS', 0)) or max(1, threads // 2)
+
+    def app_factory(background=True):
+        # the one-off commands neither create the indexes nor build the stores in the background
+        kwargs = {} if background else {'ensure_indexes': False, 'build_interval': 0}
+        return create_app(
+            configs=configs, mongodb_uri=args.url, collection_name=args.collection, query_timeout_ms=query_timeout,
+            live_max_streams=live_max_streams, **kwargs,
+        )
+
+    port = os.getenv('PORT', 5000)
+    if args.command == 'serve':
+        from .dash_app.serving import serve
+        serve(app_factory, port=port, workers=args.workers, threads=threads)
+        return
+    app = app_factory(background=not (args.check_plans or args.command == 'build'))
+    if args.command == 'build':
+        from .dash_app.builder import build_all
+        from .dash_app.indexes import ensure_indexes
+        for k, logs_coll in app.logs_map.items():
+            if app.configs[k].create_indexes:
+                ensure_indexes(logs_coll, app.configs[k])
+        build_all(app.logs_map, app.configs)
+        return
+    if args.check_plans:
+        from .dash_app.indexes import check_plans
+        reports = check_plans(app.logs_map)
+        for report in reports:
+            print(report)
+        sys.exit(0 if all(report.ok for report in reports) else 1)
+    app.run('0.0.0.0', port=port, debug=args.debug)
 
 
 if __name__ == '__main__':
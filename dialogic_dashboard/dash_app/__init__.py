@@ -1,25 +1,35 @@
 import flask_login
 import os
-import pymongo
 
 from flask import Flask
 from flask_bootstrap import Bootstrap
 from flask_login import current_user
 
 from .app_config import AppConfig
+from .builder import BUILD_INTERVAL, build_in_background
+from .cache import ResultCache, make_cache_backend
+from .clients import LazyLogsMap, get_logs_collection
+from .indexes import ensure_indexes_in_background
+from .metrics import install_metrics
+from .serving import install_query_timeout
 
 login_manager = flask_login.LoginManager()
 
 
 def load_logs(mongo_uri=None, logs_collection=None):
-    db = pymongo.MongoClient(mongo_uri or os.getenv('MONGODB_URI')).get_default_database()
-    coll_name = logs_collection or os.getenv('LOGS_COLLECTION', 'message_logs')
-    logs_coll = db.get_collection(coll_name)
-    logs_coll.create_index([('text', 'text')], default_language='russian')
-    return logs_coll
+    config = AppConfig(
+        id='default',
+        name='default',
+        database_uri=mongo_uri or os.getenv('MONGODB_URI'),
+        logs_collection_name=logs_collection or os.getenv('LOGS_COLLECTION', 'message_logs'),
+    )
+    return get_logs_collection(config)
 
 
-def create_app(configs=None, mongodb_uri=None, collection_name=None):
+def create_app(
+        configs=None, mongodb_uri=None, collection_name=None, ensure_indexes=True, cache_url=None,
+        query_timeout_ms=None, build_interval=BUILD_INTERVAL, live_max_streams=None,
+):
     app = Flask(__name__)
     app.secret_key = os.getenv('APP_SECRET', 'doMino')
     Bootstrap(app)
@@ -32,20 +42,48 @@ def create_app(configs=None, mongodb_uri=None, collection_name=None):
     from .views import bp as bp2, get_current_coll
     app.register_blueprint(bp2)
 
+    from .export import bp as bp3
+    app.register_blueprint(bp3)
+
+    from .overview import bp as bp4
+    app.register_blueprint(bp4)
+
+    from .live import bp as bp5
+    app.register_blueprint(bp5)
+
     if not configs:
         configs = {'default': {
             'name': 'default',
             'database_uri': mongodb_uri or os.getenv('MONGODB_URI'),
             'logs_collection_name': collection_name or os.getenv('LOGS_COLLECTION', 'message_logs'),
+            'max_pool_size': int(os.getenv('MONGODB_MAX_POOL_SIZE', 0)) or None,
+            'read_preference': os.getenv('MONGODB_READ_PREFERENCE'),
         }}
 
     app.configs = {k: AppConfig(id=k, **v) for k, v in (configs or {}).items()}
     app.default_coll = list(configs.keys())[0] if configs else None
 
-    app.logs_map = {
-        k: load_logs(mongo_uri=v.database_uri, logs_collection=v.logs_collection_name)
-        for k, v in app.configs.items()
-    }
+    # the collections connect lazily, so that each worker process gets its own connection pool after fork
+    app.logs_map = LazyLogsMap(app.configs)
+    if ensure_indexes:
+        ensure_indexes_in_background(app.logs_map, app.configs)
+    if build_interval:
+        build_in_background(app.logs_map, app.configs, interval=build_interval)
+
+    app.result_cache = ResultCache(make_cache_backend(
+        url=cache_url or os.getenv('CACHE_URL'),
+        maxsize=int(os.getenv('CACHE_MAXSIZE', 256)),
+        ttl=int(os.getenv('CACHE_TTL', 60)),
+    ))
+
+    install_metrics(app)
+
+    if live_max_streams:
+        app.config['LIVE_MAX_STREAMS'] = live_max_streams
+
+    query_timeout_ms = query_timeout_ms or int(os.getenv('QUERY_TIMEOUT_MS', 0))
+    if query_timeout_ms:
+        install_query_timeout(app, query_timeout_ms)
 
     @app.context_processor
     def inject_configs():
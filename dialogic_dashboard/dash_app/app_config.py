@@ -7,3 +7,22 @@ class AppConfig:
     name: str = attr.ib()
     database_uri: str = attr.ib()
     logs_collection_name: str = attr.ib(default='message_logs')
+    create_indexes: bool = attr.ib(default=True)
+    text_index_language: str = attr.ib(default='russian')
+    # connection pool settings, see https://pymongo.readthedocs.io/en/stable/api/pymongo/mongo_client.html
+    max_pool_size: int = attr.ib(default=None)
+    min_pool_size: int = attr.ib(default=None)
+    server_selection_timeout_ms: int = attr.ib(default=None)
+    connect_timeout_ms: int = attr.ib(default=None)
+    socket_timeout_ms: int = attr.ib(default=None)
+    read_preference: str = attr.ib(default=None)  # e.g. 'secondaryPreferred' to keep analytics off the primary
+    search_backend: str = attr.ib(default='mongo')  # 'mongo' for the $text index or 'sqlite' for a local FTS5 index
+    search_language: str = attr.ib(default=None)  # defaults to text_index_language
+    search_index_dir: str = attr.ib(default=None)  # defaults to $SEARCH_INDEX_DIR or ./search_index
+    # estimate the distinct users from sketches; can be switched per request with ?approx=1 or ?approx=0.
+    # The message and handler counts are read exactly from the stores, so they are not sampled
+    approximate: bool = attr.ib(default=False)
+    # 'mongo' runs the users, handlers and charts aggregations on MongoDB,
+    # 'parquet' on a local Parquet snapshot of the logs with DuckDB (needs `pyarrow` and `duckdb`)
+    storage_backend: str = attr.ib(default='mongo')
+    storage_dir: str = attr.ib(default=None)  # defaults to $STORAGE_DIR or ./storage
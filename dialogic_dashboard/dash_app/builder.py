@@ -0,0 +1,89 @@
+import logging
+import os
+import threading
+import time
+
+from pymongo.collection import Collection
+
+from .app_config import AppConfig
+from .cohorts import update_activity
+from .columnar import MAX_UPDATE_SIZE, get_columnar_store
+from .flows import update_flows
+from .handler_stats import update_handler_stats
+from .pairs import update_pairs
+from .rollups import update_daily_rollup
+from .search_index import MAX_UPDATE_SIZE as MAX_SEARCH_UPDATE_SIZE, get_search_index
+from .session_index import backfill_session_fields, update_session_index
+from .user_index import update_user_index
+
+logger = logging.getLogger(__name__)
+
+# the log documents processed by one step of a job outside of requests
+BUILD_BATCH_SIZE = 50000
+BUILD_INTERVAL = int(os.getenv('BUILD_INTERVAL', 60))
+
+JOBS = [
+    update_pairs,
+    update_session_index,
+    backfill_session_fields,
+    update_user_index,
+    update_daily_rollup,
+    update_handler_stats,
+    update_flows,
+    update_activity,
+]
+
+
+def build_stores(logs_coll: Collection, max_size=BUILD_BATCH_SIZE):
+    """ Catch up all the incremental stores with the logs, one batch after another """
+    for job in JOBS:
+        while job(logs_coll, max_size=max_size):
+            pass
+
+
+def build_snapshot(logs_coll: Collection, config: AppConfig):
+    """ Copy the new logs into the Parquet snapshot of the app and merge the files of the finished days """
+    store = get_columnar_store(config)
+    while store.update(logs_coll) >= MAX_UPDATE_SIZE:
+        pass
+    store.compact()
+
+
+def build_search_index(logs_coll: Collection, config: AppConfig):
+    """ Index the new logs and then the older history in the local full-text index of the app """
+    index = get_search_index(config)
+    while index.update(logs_coll) >= MAX_SEARCH_UPDATE_SIZE:
+        pass
+
+
+def build_all(logs_map, configs):
+    for k, logs_coll in logs_map.items():
+        try:
+            build_stores(logs_coll)
+        except Exception:
+            # the failed batch is released and processed again by the next run
+            logger.exception(f'Could not build the stores of {k}')
+        if configs[k].storage_backend == 'parquet':
+            try:
+                build_snapshot(logs_coll, configs[k])
+            except Exception:
+                logger.exception(f'Could not build the Parquet snapshot of {k}')
+        if configs[k].search_backend == 'sqlite':
+            try:
+                build_search_index(logs_coll, configs[k])
+            except Exception:
+                logger.exception(f'Could not build the search index of {k}')
+
+
+def build_in_background(logs_map, configs, interval=BUILD_INTERVAL):
+    """
+    Keep the stores of all configs up to date in a daemon thread, outside of the request time limits.
+    Requests process only small batches of the Mongo stores and never copy logs into the Parquet snapshots.
+    """
+    def run():
+        while True:
+            build_all(logs_map, configs)
+            time.sleep(interval)
+    thread = threading.Thread(target=run, name='build-stores', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,104 @@
+import hashlib
+import threading
+import time
+
+from collections import Counter, OrderedDict
+
+from bson import json_util
+from pymongo.collection import Collection
+
+from .incremental import data_version
+
+
+class LRUCache:
+    def __init__(self, maxsize=256, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return False, None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._items[key]
+                return False, None
+            self._items.move_to_end(key)
+            return True, value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class RedisCache:
+    """
+    A cache shared between workers; needs the optional `redis` package (`pip install dialogic_dashboard[redis]`).
+    The values are stored as extended JSON, so tuples come back as lists.
+    """
+    def __init__(self, url, ttl=60, prefix='dialogic_dashboard:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            return False, None
+        return True, json_util.loads(raw)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json_util.dumps(value), ex=self.ttl)
+
+    def __len__(self):
+        return sum(1 for _ in self.client.scan_iter(match=self.prefix + '*'))
+
+
+def make_cache_backend(url=None, maxsize=256, ttl=60):
+    if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisCache(url, ttl=ttl)
+    return LRUCache(maxsize=maxsize, ttl=ttl)
+
+
+class ResultCache:
+    """
+    Cache the results of the `find_*` functions.
+    Every key includes the `data_version` of the log collection, so new logs and new store batches invalidate old entries.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def make_key(self, coll_key, name, version, kwargs):
+        raw = json_util.dumps([coll_key, name, version, sorted(kwargs.items())])
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def call(self, coll_key, logs_coll: Collection, func, **kwargs):
+        name = func.__name__
+        key = self.make_key(coll_key, name, data_version(logs_coll), kwargs)
+        found, value = self.backend.get(key)
+        if found:
+            self.hits[name] += 1
+            return value
+        self.misses[name] += 1
+        value = func(logs_coll=logs_coll, **kwargs)
+        self.backend.set(key, value)
+        return value
+
+    def stats(self):
+        return {
+            'size': len(self.backend),
+            'hits': dict(self.hits),
+            'misses': dict(self.misses),
+        }
@@ -0,0 +1,60 @@
+import os
+import threading
+
+from collections.abc import Mapping
+
+import pymongo
+
+from pymongo.collection import Collection
+
+from .app_config import AppConfig
+from .metrics import QueryListener
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def client_options(config: AppConfig):
+    options = {
+        'maxPoolSize': config.max_pool_size,
+        'minPoolSize': config.min_pool_size,
+        'serverSelectionTimeoutMS': config.server_selection_timeout_ms,
+        'connectTimeoutMS': config.connect_timeout_ms,
+        'socketTimeoutMS': config.socket_timeout_ms,
+        'readPreference': config.read_preference,
+    }
+    return {k: v for k, v in options.items() if v is not None}
+
+
+def get_client(uri, **options) -> pymongo.MongoClient:
+    """
+    Return a client shared by all configs with the same uri and options.
+    Clients are created per process, so that each forked worker opens its own connection pool.
+    """
+    key = (os.getpid(), uri, tuple(sorted(options.items())))
+    with _lock:
+        if key not in _clients:
+            listener = QueryListener()
+            _clients[key] = pymongo.MongoClient(uri, connect=False, event_listeners=[listener], **options)
+            listener.client = _clients[key]
+        return _clients[key]
+
+
+def get_logs_collection(config: AppConfig) -> Collection:
+    client = get_client(config.database_uri or os.getenv('MONGODB_URI'), **client_options(config))
+    return client.get_default_database().get_collection(config.logs_collection_name)
+
+
+class LazyLogsMap(Mapping):
+    """ The log collections of `app.logs_map`, connected on first use in the current process """
+    def __init__(self, configs):
+        self.configs = configs
+
+    def __getitem__(self, key) -> Collection:
+        return get_logs_collection(self.configs[key])
+
+    def __iter__(self):
+        return iter(self.configs)
+
+    def __len__(self):
+        return len(self.configs)
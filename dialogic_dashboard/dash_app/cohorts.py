@@ -0,0 +1,149 @@
+import datetime
+
+from collections import defaultdict
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+
+from .incremental import REQUEST_BATCH_SIZE, claim_batch, side_collection, write_in_batches
+from .rollups import parse_time
+
+ACTIVITY_JOB = 'activity'
+EPOCH = datetime.date(1970, 1, 1)
+# the length of a period in days; the weeks start on Monday
+PERIOD_DAYS = {'day': 1, 'week': 7}
+# the most periods after the first one that `find_cohorts` counts
+MAX_PERIODS = 366
+
+
+def activity_coll(logs_coll: Collection) -> Collection:
+    return side_collection(logs_coll, 'activity')
+
+
+def day_number(day):
+    """ The number of days since 1970-01-01 for a "YYYY-MM-DD" string, or None if it is not a date """
+    try:
+        return (datetime.date.fromisoformat(day) - EPOCH).days
+    except (TypeError, ValueError):
+        return None
+
+
+def day_label(number):
+    return (EPOCH + datetime.timedelta(days=number)).isoformat()
+
+
+def update_activity(logs_coll: Collection, max_size=REQUEST_BATCH_SIZE):
+    """ Keep for each user the set of days when they wrote to the bot, as day numbers """
+    # sets and extremes only, so processing a batch again does no harm
+    with claim_batch(logs_coll, ACTIVITY_JOB, max_size) as batch:
+        if batch is None:
+            return False
+        rows = logs_coll.aggregate([
+            {'$match': dict(batch.match, user_id={"$exists": True}, from_user=True)},
+            {'$group': {'_id': '$user_id', 'days': {'$addToSet': {'$substr': ['$timestamp', 0, 10]}}}},
+        ], allowDiskUse=True)
+        requests = []
+        for row in rows:
+            days = sorted({n for n in map(day_number, row['days']) if n is not None})
+            if not days:
+                continue
+            requests.append(UpdateOne(
+                {'_id': row['_id']},
+                {
+                    '$addToSet': {'days': {'$each': days}},
+                    '$min': {'first_day': days[0]},
+                    '$max': {'last_day': days[-1]},
+                },
+                upsert=True,
+            ))
+        write_in_batches(activity_coll(logs_coll), requests)
+    return True
+
+
+def period_start(day_expr, granularity):
+    """ The first day of the period of a day number; 1970-01-01 was a Thursday, so Monday is 3 days before it """
+    if granularity == 'day':
+        return day_expr
+    return {'$subtract': [day_expr, {'$mod': [{'$add': [day_expr, 3]}, 7]}]}
+
+
+def cohorts_pipeline(granularity, low=None):
+    """ Count the users of each cohort active N periods later, for the users active since the day number `low` """
+    length = PERIOD_DAYS[granularity]
+    cohort = period_start('$first_day', granularity)
+    return [
+        {'$match': {'last_day': {'$gte': low}} if low is not None else {}},
+        {'$project': {
+            '_id': False,
+            'cohort': cohort,
+            # the distinct periods of activity of the user, counted from the period of the cohort
+            'offsets': {'$setUnion': [{'$map': {
+                'input': '$days',
+                'in': {'$floor': {'$divide': [{'$subtract': ['$$this', cohort]}, length]}},
+            }}]},
+        }},
+        {'$unwind': '$offsets'},
+        {'$group': {'_id': {'cohort': '$cohort', 'offset': '$offsets'}, 'users': {'$sum': 1}}},
+    ]
+
+
+def find_cohorts(logs_coll: Collection, granularity='week', periods=12, start=None, end=None):
+    """
+    Group users into cohorts by the period of their first message and count, for each cohort,
+    the users active N periods later. Also count the active users of each period, new and returning.
+    Only the cohorts and the periods within [start, end) are returned.
+    """
+    if granularity not in PERIOD_DAYS:
+        raise ValueError(f'Unknown cohort granularity "{granularity}"')
+    length = PERIOD_DAYS[granularity]
+    start, end = parse_time(start), parse_time(end)
+    low = (start.date() - EPOCH).days if start else None
+    high = (end.date() - EPOCH).days if end else None
+    update_activity(logs_coll)
+    rows = activity_coll(logs_coll).aggregate(cohorts_pipeline(granularity, low), allowDiskUse=True)
+
+    def in_range(day):
+        return (low is None or day + length > low) and (high is None or day < high)
+
+    matrix = defaultdict(dict)
+    active = defaultdict(lambda: {'new': 0, 'returning': 0})
+    for row in rows:
+        first, offset, users = int(row['_id']['cohort']), int(row['_id']['offset']), row['users']
+        period = first + offset * length
+        if not in_range(period):
+            continue
+        active[period]['new' if offset == 0 else 'returning'] += users
+        if in_range(first) and offset < periods:
+            matrix[first][offset] = users
+
+    last_day = max(active) if active else None
+    cohorts = []
+    returned, sizes = [0] * periods, [0] * periods
+    for first in sorted(matrix):
+        size = matrix[first].get(0, 0)
+        # the periods that have not started yet are left out rather than counted as zero
+        elapsed = min(periods, (last_day - first) // length + 1)
+        counts = [matrix[first].get(n, 0) for n in range(elapsed)]
+        cohorts.append({
+            'cohort': day_label(first),
+            'users': size,
+            'returned': counts,
+            'rates': [c / size if size else 0 for c in counts],
+        })
+        for n, count in enumerate(counts):
+            returned[n] += count
+            sizes[n] += size
+    return {
+        'granularity': granularity,
+        'cohorts': cohorts,
+        # the share of users active N periods after the first one, over all the cohorts that have reached N
+        'retention': {
+            'indexes': list(range(periods)),
+            'values': [r / s if s else None for r, s in zip(returned, sizes)],
+        },
+        'active': {
+            'indexes': [day_label(p) for p in sorted(active)],
+            'new': [active[p]['new'] for p in sorted(active)],
+            'returning': [active[p]['returning'] for p in sorted(active)],
+        },
+    }
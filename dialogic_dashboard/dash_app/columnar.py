@@ -0,0 +1,288 @@
+import datetime
+import glob
+import json
+import os
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+from bson import ObjectId
+from pymongo.collection import Collection
+
+from .app_config import AppConfig
+from .cursors import decode_cursor
+from .incremental import newest_settled_id
+from .rollups import DEFAULT_HOURLY_RANGE, GRANULARITIES, check_bucket_count, fill_buckets, parse_time
+
+try:
+    import fcntl
+except ImportError:  # no locks between processes on Windows
+    fcntl = None
+
+# documents copied per call of `update`, so that one step of the background build stays short
+MAX_UPDATE_SIZE = 200000
+# a day gets a new file with each update; the files of a day are merged into one after the day is over,
+# or earlier if there are this many of them
+COMPACT_OPEN_DAY_FILES = 32
+# the merged files are deleted later, when the queries that have listed them are surely finished
+OBSOLETE_SECONDS = 600
+
+SNAPSHOT_PROJECTION = {
+    'timestamp': True, 'from_user': True, 'user_id': True, 'handler': True, 'text': True, 'request_id': True,
+    'session_id': True, 'data.session.session_id': True,
+}
+FILTER_COLUMNS = {'user_id', 'handler', 'session_id', 'request_id'}
+
+_stores = {}
+_lock = threading.Lock()
+
+
+def snapshot_row(doc):
+    timestamp = doc.get('timestamp')
+    timestamp = str(timestamp) if timestamp is not None else None
+    try:
+        ts = datetime.datetime.fromisoformat(timestamp[:19]) if timestamp else None
+    except ValueError:
+        ts = None
+    session = (doc.get('data') or {}).get('session') or {}
+    user_id = doc.get('user_id')
+    request_id = doc.get('request_id')
+    return {
+        'id': str(doc['_id']),
+        'timestamp': timestamp,
+        'ts': ts,
+        'from_user': bool(doc.get('from_user')),
+        'user_id': str(user_id) if user_id is not None else None,
+        'handler': doc.get('handler'),
+        'text': doc.get('text') if isinstance(doc.get('text'), str) else None,
+        # bots may log the ids as numbers or ObjectIds, but the column is a string
+        'request_id': str(request_id) if request_id is not None else None,
+        'session_id': doc.get('session_id') or session.get('session_id'),
+    }
+
+
+def where_filters(filters):
+    conditions, params = [], []
+    for column, value in (filters or {}).items():
+        if column not in FILTER_COLUMNS:
+            raise ValueError(f'Cannot filter the columnar store by "{column}"')
+        conditions.append(f'{column} = ?')
+        params.append(value)
+    return conditions, params
+
+
+class ColumnarStore:
+    """
+    A snapshot of one log collection in Parquet files partitioned by day, queried with DuckDB.
+    Needs the optional `pyarrow` and `duckdb` packages.
+    The snapshot is appended incrementally by `_id` and compacted by the background build (see `builder.py`),
+    the requests only read it. The files that make up the snapshot are listed in its state.
+    """
+    def __init__(self, path):
+        import duckdb
+        import pyarrow
+        self.duckdb = duckdb
+        self.pyarrow = pyarrow
+        self.path = path
+        self.lock = threading.Lock()
+        self.schema = pyarrow.schema([
+            ('id', pyarrow.string()),
+            ('timestamp', pyarrow.string()),
+            ('ts', pyarrow.timestamp('us')),
+            ('from_user', pyarrow.bool_()),
+            ('user_id', pyarrow.string()),
+            ('handler', pyarrow.string()),
+            ('text', pyarrow.string()),
+            ('request_id', pyarrow.string()),
+            ('session_id', pyarrow.string()),
+        ])
+        os.makedirs(path, exist_ok=True)
+
+    @contextmanager
+    def locked(self):
+        """ Let one thread of one process at a time change the snapshot """
+        with self.lock, open(os.path.join(self.path, '.lock'), 'w') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def read_state(self):
+        try:
+            with open(os.path.join(self.path, 'state.json'), 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {}
+        if 'files' not in state:
+            # the snapshots written before the list of files was kept
+            files = glob.glob(os.path.join(self.path, 'day=*', '*.parquet'))
+            state['files'] = sorted(os.path.relpath(name, self.path) for name in files)
+        return state
+
+    def write_state(self, state):
+        tmp = os.path.join(self.path, 'state.json.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp, os.path.join(self.path, 'state.json'))
+
+    def write_file(self, name, rows):
+        import pyarrow.parquet
+        path = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        table = rows
+        if not isinstance(table, self.pyarrow.Table):
+            table = self.pyarrow.Table.from_pylist(rows, schema=self.schema)
+        pyarrow.parquet.write_table(table, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def update(self, logs_coll: Collection, max_size=MAX_UPDATE_SIZE):
+        """ Copy the log documents newer than the stored watermark; return the number of new documents """
+        with self.locked():
+            state = self.read_state()
+            high = newest_settled_id(logs_coll)
+            if high is None:
+                return 0
+            low = state.get('watermark')
+            id_range = {'$lte': high}
+            if low:
+                id_range['$gt'] = ObjectId(low)
+            docs = list(logs_coll.find(
+                {'_id': id_range}, projection=SNAPSHOT_PROJECTION, sort=[('_id', 1)], limit=max_size,
+            ))
+            days = defaultdict(list)
+            for doc in docs:
+                row = snapshot_row(doc)
+                days[(row['timestamp'] or '')[:10] or 'unknown'].append(row)
+            files = set(state['files'])
+            for day, rows in days.items():
+                # the files that are not listed in the state are not read, so a crash leaves no duplicates,
+                # and a retry rewrites the same file
+                name = os.path.join(f'day={day}', f'part-{low or "start"}.parquet')
+                self.write_file(name, rows)
+                files.add(name)
+            complete = len(docs) < max_size
+            state.update(
+                watermark=str(high if complete else docs[-1]['_id']), updated=time.time(), complete=complete,
+                files=sorted(files),
+            )
+            self.write_state(state)
+            return len(docs)
+
+    def compact(self):
+        """ Merge the files of each finished day (and of a day with too many files) into one """
+        import pyarrow.parquet
+        today = datetime.datetime.utcnow().strftime('%Y-%m-%d')
+        with self.locked():
+            state = self.read_state()
+            by_day = defaultdict(list)
+            for name in state['files']:
+                by_day[os.path.dirname(name)].append(name)
+            files = set(state['files'])
+            obsolete = dict(state.get('obsolete') or {})
+            for directory, names in by_day.items():
+                if len(names) < 2 or (directory >= f'day={today}' and len(names) < COMPACT_OPEN_DAY_FILES):
+                    continue
+                tables = [
+                    pyarrow.parquet.read_table(os.path.join(self.path, name), schema=self.schema) for name in names
+                ]
+                merged = os.path.join(directory, f'compact-{state["watermark"]}.parquet')
+                self.write_file(merged, self.pyarrow.concat_tables(tables))
+                files.difference_update(names)
+                files.add(merged)
+                obsolete.update({name: time.time() for name in names if name != merged})
+            for name, since in list(obsolete.items()):
+                if time.time() - since > OBSOLETE_SECONDS and name not in files:
+                    try:
+                        os.remove(os.path.join(self.path, name))
+                    except FileNotFoundError:
+                        pass
+                    del obsolete[name]
+            state.update(files=sorted(files), obsolete=obsolete)
+            self.write_state(state)
+
+    def query(self, sql, params=()):
+        """ Run `sql` over the `logs` view of the snapshot and return the rows as dicts """
+        files = [os.path.join(self.path, name) for name in self.read_state().get('files', [])]
+        if not files:
+            return []
+        con = self.duckdb.connect()
+        try:
+            source = ', '.join("'{}'".format(name.replace("'", "''")) for name in files)
+            con.execute(
+                f"CREATE VIEW logs AS SELECT * FROM read_parquet([{source}], "
+                f"hive_partitioning=true, hive_types_autocast=false)"
+            )
+            cursor = con.execute(sql, list(params))
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        finally:
+            con.close()
+
+    def find_users(self, logs_coll: Collection, page=0, page_size=15, filters=None, after=None, before=None):
+        conditions, params = [], []
+        if filters:
+            conditions, params = where_filters({('user_id' if k == '_id' else k): v for k, v in filters.items()})
+        having, having_params = [], []
+        if after or before:
+            key_value, _id = decode_cursor(after or before)
+            op = '<' if after else '>'
+            having.append(f'(last_time {op} ? OR (last_time = ? AND _id {op} ?))')
+            having_params.extend([key_value, key_value, _id])
+        direction = 'ASC' if before else 'DESC'
+        sql = (
+            "SELECT user_id AS _id, min(timestamp) AS first_time, max(timestamp) AS last_time, count(*) AS messages "
+            "FROM logs WHERE " + ' AND '.join(['from_user', 'user_id IS NOT NULL'] + conditions) + " GROUP BY user_id"
+        )
+        if having:
+            sql = f"SELECT * FROM ({sql}) WHERE " + ' AND '.join(having)
+        sql += f" ORDER BY last_time {direction}, _id {direction} LIMIT ? OFFSET ?"
+        offset = 0 if (after or before) else page * page_size
+        users = self.query(sql, params + having_params + [page_size, offset])
+        if before:
+            users.reverse()
+        return users
+
+    def count_users(self, logs_coll: Collection, approx=False):
+        rows = self.query("SELECT count(DISTINCT user_id) AS users FROM logs WHERE from_user")
+        return (rows[0]['users'] if rows else 0), 0
+
+    def find_handlers(self, logs_coll: Collection):
+        return self.query(
+            "SELECT handler AS _id, min(timestamp) AS first_time, max(timestamp) AS last_time, "
+            "arg_max(text, id) AS response_example, count(*) AS messages "
+            "FROM logs WHERE NOT from_user AND handler IS NOT NULL GROUP BY handler ORDER BY messages DESC"
+        )
+
+    def time_series(self, logs_coll: Collection, field, start=None, end=None, granularity='day', **kwargs):
+        """ The same as `rollups.time_series`, counted exactly from the snapshot """
+        if granularity not in GRANULARITIES:
+            raise ValueError(f'Unknown granularity "{granularity}"')
+        start, end = parse_time(start), parse_time(end)
+        if granularity == 'hour':
+            start = start or datetime.datetime.utcnow() - DEFAULT_HOURLY_RANGE
+        check_bucket_count(start, end, granularity)
+        # the conditions on the partition column let DuckDB skip the files of the other days
+        conditions, params = ['from_user', 'ts IS NOT NULL'], []
+        if start:
+            conditions.extend(['day >= ?', 'ts >= ?'])
+            params.extend([start.strftime('%Y-%m-%d'), start])
+        if end:
+            conditions.extend(['day <= ?', 'ts < ?'])
+            params.extend([end.strftime('%Y-%m-%d'), end])
+        value = 'count(DISTINCT user_id)' if field == 'users' else 'count(*)'
+        rows = self.query(
+            f"SELECT date_trunc('{granularity}', ts) AS bucket, {value} AS count FROM logs "
+            f"WHERE {' AND '.join(conditions)} GROUP BY bucket",
+            params,
+        )
+        return fill_buckets({row['bucket']: row['count'] for row in rows}, start, end, granularity)
+
+
+def get_columnar_store(config: AppConfig) -> ColumnarStore:
+    directory = config.storage_dir or os.getenv('STORAGE_DIR', 'storage')
+    path = os.path.join(directory, config.id)
+    with _lock:
+        if path not in _stores:
+            _stores[path] = ColumnarStore(path)
+        return _stores[path]
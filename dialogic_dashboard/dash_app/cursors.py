@@ -0,0 +1,61 @@
+import base64
+import binascii
+
+from bson import json_util
+from bson.errors import InvalidBSON, InvalidId
+from pymongo.collection import Collection
+
+
+def encode_cursor(key_value, _id) -> str:
+    """ Make an opaque url-safe token from the sort key and `_id` of the last seen item """
+    raw = json_util.dumps([key_value, _id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token: str):
+    """ Return the sort key and `_id` of a token made by `encode_cursor`, or raise ValueError if it is malformed """
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        key_value, _id = json_util.loads(raw.decode('utf-8'))
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError, InvalidBSON, InvalidId) as e:
+        raise ValueError(f'Invalid cursor "{token}"') from e
+    return key_value, _id
+
+
+def keyset_filter(key, token, older=True):
+    """ Match the items strictly after (older=True) or before the cursor in the descending (key, _id) order """
+    key_value, _id = decode_cursor(token)
+    op = '$lt' if older else '$gt'
+    return {
+        key: {op + 'e': key_value},
+        '$or': [{key: {op: key_value}}, {'_id': {op: _id}}],
+    }
+
+
+def keyset_find(coll: Collection, query, key, page=0, page_size=15, after=None, before=None, projection=None):
+    """
+    Read one page of `coll` sorted by (key, _id) descending.
+    `after` continues to older items, `before` goes back to newer ones; without them, the legacy `page` is skipped.
+    """
+    query = dict(query or {})
+    if after or before:
+        query = {'$and': [query, keyset_filter(key, after or before, older=bool(after))]}
+    direction = 1 if before else -1
+    cursor = coll.find(query, projection=projection, sort=[(key, direction), ('_id', direction)])
+    if not (after or before) and page:
+        cursor = cursor.skip(page * page_size)
+    items = list(cursor.limit(page_size))
+    if before:
+        items.reverse()
+    return items
+
+
+def page_links(items, key, page_size, page=0, after=None, before=None):
+    """ Return the `before` and `after` tokens for the links to the newer and the older pages """
+    if not items:
+        return None, None
+    newer = encode_cursor(items[0].get(key), items[0]['_id'])
+    older = encode_cursor(items[-1].get(key), items[-1]['_id'])
+    has_newer = bool(page or after or (before and len(items) == page_size))
+    has_older = len(items) == page_size or bool(before)
+    return (newer if has_newer else None), (older if has_older else None)
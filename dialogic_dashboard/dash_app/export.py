@@ -0,0 +1,168 @@
+import csv
+import io
+import json
+import zlib
+
+import attr
+import flask_login
+
+from flask import Blueprint, Response, abort, current_app, request, stream_with_context
+from flask_login import current_user
+from pymongo.collection import Collection
+
+from .pairs import COMPLETE, pairs_coll, update_pairs
+from .session_index import sessions_coll, update_session_index
+from .user_index import users_coll, update_user_index
+from .views import get_logs_coll, int_arg
+
+bp = Blueprint('export', __name__)
+
+MAX_BATCH_SIZE = 10000
+
+
+@attr.s()
+class ExportSpec:
+    get_coll = attr.ib()
+    update = attr.ib()
+    time_field: str = attr.ib()
+    fields: list = attr.ib()
+    filters: list = attr.ib()  # request arguments that are matched by equality
+
+
+EXPORTS = {
+    'messages': ExportSpec(
+        get_coll=pairs_coll, update=update_pairs, time_field='timestamp',
+        fields=[
+            '_id', 'timestamp', 'user_id', 'session_id', 'text', 'response_text', 'handler',
+            'request_type', 'directives', 'client_id',
+        ],
+        filters=['user_id', 'session_id', 'handler'],
+    ),
+    'sessions': ExportSpec(
+        get_coll=sessions_coll, update=update_session_index, time_field='latest',
+        fields=['_id', 'user_id', 'first_time', 'latest', 'len', 'first_text', 'last_text'],
+        filters=['user_id'],
+    ),
+    'users': ExportSpec(
+        get_coll=users_coll, update=update_user_index, time_field='last_time',
+        fields=['_id', 'first_time', 'last_time', 'messages'],
+        filters=[],
+    ),
+}
+SEARCH_FIELDS = ['_id', 'timestamp', 'user_id', 'from_user', 'text', 'handler', 'request_id', 'session_id']
+
+
+def make_query(spec: ExportSpec, args):
+    query = {}
+    for name in spec.filters:
+        if args.get(name):
+            query[name] = args[name]
+    time_range = {}
+    if args.get('from'):
+        time_range['$gte'] = args['from']
+    if args.get('to'):
+        time_range['$lt'] = args['to']
+    if time_range:
+        query[spec.time_field] = time_range
+    return query
+
+
+def choose_fields(available, args):
+    if not args.get('fields'):
+        return available
+    fields = [f for f in args['fields'].split(',') if f in available]
+    if not fields:
+        abort(400, 'None of the requested fields can be exported')
+    return fields
+
+
+def serialize_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False, default=str)
+    return '' if value is None else str(value)
+
+
+def iter_ndjson(docs, fields):
+    for doc in docs:
+        yield json.dumps({f: doc.get(f) for f in fields}, ensure_ascii=False, default=str) + '\n'
+
+
+def iter_csv(docs, fields, batch_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for i, doc in enumerate(docs, 1):
+        writer.writerow([serialize_value(doc.get(f)) for f in fields])
+        if i % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_gzip(chunks):
+    compressor = zlib.compressobj(wbits=31)  # 31 means the gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_export(docs, fields, name, fmt='ndjson', batch_size=1000, gzip=False):
+    if fmt == 'csv':
+        chunks = iter_csv(docs, fields, batch_size=batch_size)
+        mimetype = 'text/csv'
+    else:
+        chunks = iter_ndjson(docs, fields)
+        mimetype = 'application/x-ndjson'
+    filename = f'{name}.{fmt}'
+    if gzip:
+        chunks = iter_gzip(chunks)
+        mimetype = 'application/gzip'
+        filename += '.gz'
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
+
+
+def get_export_args():
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in {'ndjson', 'csv'}:
+        abort(400, f'Unknown export format "{fmt}"')
+    batch_size = int_arg('batch_size', 1000, low=1, high=MAX_BATCH_SIZE)
+    gzip = request.args.get('gzip') in {'1', 'true', 'yes'}
+    return fmt, batch_size, gzip
+
+
+@bp.route('/api/export/<kind>')
+@bp.route('/api/<coll_name>/export/<kind>')
+@flask_login.login_required
+def export(kind, coll_name=None):
+    if kind not in EXPORTS:
+        abort(404)
+    logs_coll: Collection = get_logs_coll(current_app, current_user, coll_name=coll_name)
+    fmt, batch_size, gzip = get_export_args()
+    spec = EXPORTS[kind]
+    if kind == 'messages' and request.args.get('query'):
+        # full text search results come straight from the log collection
+        fields = choose_fields(SEARCH_FIELDS, request.args)
+        query = {'$text': {'$search': request.args['query']}}
+        if request.args.get('query_type'):
+            query['from_user'] = request.args['query_type'] != 'res'
+        docs = logs_coll.find(
+            query, projection=fields, sort=[('timestamp', -1)], batch_size=batch_size,
+        )
+        return stream_export(docs, fields, name='search', fmt=fmt, batch_size=batch_size, gzip=gzip)
+
+    spec.update(logs_coll)
+    fields = choose_fields(spec.fields, request.args)
+    query = make_query(spec, request.args)
+    if kind == 'messages':
+        query.update(COMPLETE)
+    docs = spec.get_coll(logs_coll).find(
+        query, projection=fields, sort=[(spec.time_field, -1), ('_id', -1)], batch_size=batch_size,
+    )
+    return stream_export(docs, fields, name=kind, fmt=fmt, batch_size=batch_size, gzip=gzip)
@@ -0,0 +1,155 @@
+import itertools
+import json
+
+from collections import Counter, defaultdict
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+
+from .incremental import REQUEST_BATCH_SIZE, Batch, batch_guard, claim_batch, side_collection, write_in_batches
+from .session_index import COMPLEX_ID, SESSION_MATCH
+
+FLOW_JOB = 'flows'
+# the pseudo-handlers before the first and after the last response of a session
+START = '[start]'
+END = '[end]'
+# sessions are grouped into paths by their first handlers
+PATH_LENGTH = 3
+# the sessions whose stored tails are read with one query
+CHUNK_SIZE = 1000
+# the most paths and drop-off points that `find_flow` returns
+MAX_TOP = 1000
+
+
+def flow_sessions_coll(logs_coll: Collection) -> Collection:
+    return side_collection(logs_coll, 'flow_sessions')
+
+
+def flow_transitions_coll(logs_coll: Collection) -> Collection:
+    return side_collection(logs_coll, 'flow_transitions')
+
+
+def flow_paths_coll(logs_coll: Collection) -> Collection:
+    return side_collection(logs_coll, 'flow_paths')
+
+
+def update_flows(logs_coll: Collection, max_size=REQUEST_BATCH_SIZE):
+    """
+    Count the transitions between the handlers of consecutive responses in each session, and the paths of sessions.
+    The new responses are grouped by session on the server in timestamp order; each session continues
+    from its tail (the last handler and the path so far) stored by the previous runs.
+    The last handler of a session is counted as a transition to END and moved when the session goes on.
+    """
+    with claim_batch(logs_coll, FLOW_JOB, max_size) as batch:
+        if batch is None:
+            return False
+        apply_flows(logs_coll, batch)
+    return True
+
+
+def apply_flows(logs_coll: Collection, batch: Batch):
+    rows = logs_coll.aggregate([
+        {'$match': dict(batch.match, from_user=False, handler={'$exists': True}, **SESSION_MATCH)},
+        {'$sort': {'timestamp': 1}},
+        {'$group': {'_id': COMPLEX_ID, 'handlers': {'$push': '$handler'}, 'latest': {'$max': '$timestamp'}}},
+    ], allowDiskUse=True)
+
+    transitions = Counter()
+    paths = Counter()
+    while True:
+        chunk = list(itertools.islice(rows, CHUNK_SIZE))
+        if not chunk:
+            break
+        tails = {
+            tail['_id']: tail
+            for tail in flow_sessions_coll(logs_coll).find({'_id': {'$in': [row['_id'] for row in chunk]}})
+        }
+        updates = []
+        for row in chunk:
+            tail = tails.get(row['_id'])
+            if tail and tail.get('batch') == batch.id:
+                # the batch is processed again: start from the tail that the session had before it
+                tail = tail.get('before')
+            last = tail['last_handler'] if tail else START
+            if tail:
+                transitions[last, END] -= 1
+            for handler in row['handlers']:
+                transitions[last, handler] += 1
+                last = handler
+            transitions[last, END] += 1
+            path = tail['path'] if tail else []
+            new_path = (path + row['handlers'])[:PATH_LENGTH]
+            if new_path != path:
+                if path:
+                    paths[tuple(path)] -= 1
+                paths[tuple(new_path)] += 1
+            before = {'last_handler': tail['last_handler'], 'path': tail['path']} if tail else None
+            updates.append(UpdateOne(
+                batch_guard(row['_id'], batch),
+                {
+                    '$set': {'last_handler': last, 'path': new_path, 'batch': batch.id, 'before': before},
+                    '$max': {'latest': row['latest']},
+                    '$inc': {'responses': len(row['handlers'])},
+                },
+                upsert=True,
+            ))
+        write_in_batches(flow_sessions_coll(logs_coll), updates)
+
+    write_in_batches(flow_transitions_coll(logs_coll), (
+        UpdateOne(
+            batch_guard(json.dumps([source, target]), batch),
+            {'$inc': {'count': count}, '$set': {'source': source, 'target': target, 'batch': batch.id}},
+            upsert=True,
+        )
+        for (source, target), count in transitions.items() if count
+    ))
+    write_in_batches(flow_paths_coll(logs_coll), (
+        UpdateOne(
+            batch_guard(json.dumps(path), batch),
+            {'$inc': {'count': count}, '$set': {'path': list(path), 'batch': batch.id}},
+            upsert=True,
+        )
+        for path, count in paths.items() if count
+    ))
+
+
+def find_flow(logs_coll: Collection, handler=None, top=20):
+    """
+    The transitions between handlers with their share among the transitions from the same handler,
+    the drop-off points (the handlers that sessions end with) and the most frequent paths of sessions.
+    With `handler`, only the transitions and paths that include it are returned.
+    """
+    update_flows(logs_coll)
+    transitions = list(flow_transitions_coll(logs_coll).find(
+        {'count': {'$gt': 0}}, projection={'_id': False, 'batch': False},
+    ))
+    outgoing = defaultdict(int)
+    incoming = defaultdict(int)
+    for item in transitions:
+        outgoing[item['source']] += item['count']
+        incoming[item['target']] += item['count']
+    for item in transitions:
+        item['share'] = item['count'] / outgoing[item['source']]
+    transitions.sort(key=lambda item: -item['count'])
+
+    exits = {item['source']: item['count'] for item in transitions if item['target'] == END}
+    dropoffs = [
+        {'handler': name, 'responses': incoming[name], 'exits': count, 'rate': count / incoming[name]}
+        for name, count in exits.items() if incoming[name]
+    ]
+    dropoffs.sort(key=lambda item: -item['exits'])
+
+    path_filter = {'count': {'$gt': 0}}
+    if handler is not None:
+        transitions = [item for item in transitions if handler in {item['source'], item['target']}]
+        dropoffs = [item for item in dropoffs if item['handler'] == handler]
+        path_filter['path'] = handler
+    paths = list(flow_paths_coll(logs_coll).find(
+        path_filter, projection={'_id': False, 'batch': False}, sort=[('count', -1)], limit=top,
+    ))
+    return {
+        'sessions': outgoing[START],
+        'transitions': transitions,
+        'dropoffs': dropoffs,
+        'paths': paths,
+    }
@@ -0,0 +1,148 @@
+from collections import defaultdict
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+
+from .incremental import REQUEST_BATCH_SIZE, Batch, batch_guard, claim_batch, side_collection, write_in_batches
+from .sketches import space_saving_update
+
+HANDLER_STATS_JOB = 'handler_stats'
+# the most frequent request texts kept per handler
+TOP_K = 200
+MAX_RETRIES = 10
+
+
+def handler_stats_coll(logs_coll: Collection) -> Collection:
+    return side_collection(logs_coll, 'handlers')
+
+
+def handler_days_coll(logs_coll: Collection) -> Collection:
+    return side_collection(logs_coll, 'handler_days')
+
+
+def update_handler_stats(logs_coll: Collection, max_size=REQUEST_BATCH_SIZE):
+    with claim_batch(logs_coll, HANDLER_STATS_JOB, max_size) as batch:
+        if batch is None:
+            return False
+        apply_handler_stats(logs_coll, batch)
+    return True
+
+
+def apply_handler_stats(logs_coll: Collection, batch: Batch):
+    rows = logs_coll.aggregate([
+        {'$match': dict(batch.match, from_user=False, handler={'$exists': True})},
+        # the request that triggered the response; it is found by the indexed request_id
+        {'$lookup': {
+            'from': logs_coll.name,
+            'localField': 'request_id',
+            'foreignField': 'request_id',
+            'pipeline': [{'$match': {'from_user': True}}, {'$project': {'_id': False, 'text': True}}],
+            'as': 'request',
+        }},
+        {'$group': {
+            '_id': {
+                'handler': '$handler',
+                'day': {'$substr': ['$timestamp', 0, 10]},
+                'text': {'$first': '$request.text'},
+            },
+            'first_time': {'$min': '$timestamp'},
+            'last_time': {'$max': '$timestamp'},
+            'response_example': {'$last': '$text'},
+            'count': {'$sum': 1},
+        }},
+    ], allowDiskUse=True)
+
+    handlers = defaultdict(lambda: {'messages': 0, 'days': defaultdict(int), 'texts': {}})
+    for row in rows:
+        stats = handlers[row['_id']['handler']]
+        stats['messages'] += row['count']
+        stats['days'][row['_id']['day']] += row['count']
+        if not stats.get('last_time') or row['last_time'] >= stats['last_time']:
+            stats['last_time'] = row['last_time']
+            stats['response_example'] = row['response_example']
+        if not stats.get('first_time') or row['first_time'] < stats['first_time']:
+            stats['first_time'] = row['first_time']
+        text = row['_id'].get('text')
+        if text is not None:
+            found = stats['texts'].setdefault(text, {'count': 0, 'first_time': row['first_time'], 'last_time': None})
+            found['count'] += row['count']
+            found['first_time'] = min(found['first_time'], row['first_time'])
+            found['last_time'] = max(found['last_time'] or row['last_time'], row['last_time'])
+
+    coll = handler_stats_coll(logs_coll)
+    write_in_batches(coll, (
+        UpdateOne(batch_guard(handler, batch), [{'$set': {
+            'messages': {'$add': [{'$ifNull': ['$messages', 0]}, stats['messages']]},
+            'first_time': {'$min': ['$first_time', stats['first_time']]},
+            'last_time': {'$max': ['$last_time', stats['last_time']]},
+            'response_example': {'$cond': [
+                {'$gte': [stats['last_time'], {'$ifNull': ['$last_time', '']}]},
+                {'$literal': stats['response_example']},
+                '$response_example',
+            ]},
+            'batch': batch.id,
+        }}], upsert=True)
+        for handler, stats in handlers.items()
+    ))
+    for handler, stats in handlers.items():
+        merge_top_requests(coll, handler, stats['texts'], batch)
+    write_in_batches(handler_days_coll(logs_coll), (
+        UpdateOne(
+            batch_guard(f'{handler}/{day}', batch),
+            {'$inc': {'count': count}, '$set': {'handler': handler, 'day': day, 'batch': batch.id}},
+            upsert=True,
+        )
+        for handler, stats in handlers.items()
+        for day, count in stats['days'].items()
+    ))
+
+
+def merge_top_requests(coll: Collection, handler, texts, batch: Batch):
+    """
+    Fold the request counts of a batch into the top-K of the handler, unless they are already there.
+    Concurrent writers retry on a conflict; if the retries run out, the error fails the batch,
+    so that it is processed again instead of losing its counts.
+    """
+    if not texts:
+        return
+    for _ in range(MAX_RETRIES):
+        doc = coll.find_one({'_id': handler}, projection={'top_requests': True, 'version': True, 'top_batch': True})
+        doc = doc or {}
+        if doc.get('top_batch') == batch.id:
+            return
+        top = space_saving_update(doc.get('top_requests') or [], texts, TOP_K)
+        result = coll.update_one(
+            {'_id': handler, 'version': doc.get('version')},
+            {'$set': {'top_requests': top, 'top_batch': batch.id}, '$inc': {'version': 1}},
+        )
+        if result.matched_count:
+            return
+    raise RuntimeError(f'Could not merge the top requests of handler "{handler}" in {MAX_RETRIES} attempts')
+
+
+def find_handler_stats(logs_coll: Collection):
+    update_handler_stats(logs_coll)
+    return list(handler_stats_coll(logs_coll).find(
+        {}, projection={'top_requests': False, 'version': False, 'batch': False, 'top_batch': False},
+        sort=[('messages', -1)],
+    ))
+
+
+def find_top_requests(logs_coll: Collection, handler_name):
+    """ The most frequent request texts of the handler, with their counts and the possible overestimation """
+    update_handler_stats(logs_coll)
+    doc = handler_stats_coll(logs_coll).find_one({'_id': handler_name}, projection={'top_requests': True})
+    if doc is None:
+        return None
+    return [
+        {'_id': item['key'], 'count': item['count'], 'error': item['error'],
+         'first_time': item.get('first_time'), 'last_time': item.get('last_time')}
+        for item in doc.get('top_requests') or []
+    ]
+
+
+def find_handler_trend(logs_coll: Collection, handler_name):
+    """ The number of responses of the handler per day """
+    update_handler_stats(logs_coll)
+    days = list(handler_days_coll(logs_coll).find({'handler': handler_name}, sort=[('day', 1)]))
+    return {'indexes': [d['day'] for d in days], 'values': [d['count'] for d in days]}
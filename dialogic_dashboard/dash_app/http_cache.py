@@ -0,0 +1,68 @@
+import gzip
+import hashlib
+
+from bson import json_util
+from flask import Blueprint, Response, g, request
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+COMPRESSIBLE_TYPES = {'text/html', 'application/json', 'text/csv', 'text/plain'}
+# smaller bodies fit into one packet anyway
+MIN_COMPRESS_SIZE = 1024
+
+
+def make_etag(*parts):
+    return hashlib.sha1(json_util.dumps(parts).encode('utf-8')).hexdigest()
+
+
+def compress_response(response: Response):
+    """ Encode the body with brotli or gzip if the client accepts it and the body is worth it """
+    if response.direct_passthrough or response.is_streamed or response.status_code != 200:
+        return response
+    if response.mimetype not in COMPRESSIBLE_TYPES or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    data = response.get_data()
+    if encoding is None or len(data) < MIN_COMPRESS_SIZE:
+        return response
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=5))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def install_http_cache(bp: Blueprint, get_validator):
+    """
+    Answer conditional GET requests to the blueprint with 304 before running the view, and compress the responses.
+    `get_validator()` returns a cheap value that changes whenever the response to the current request may change,
+    or None if the response must not be cached.
+    """
+    @bp.before_request
+    def check_etag():
+        if request.method not in {'GET', 'HEAD'}:
+            return
+        validator = get_validator()
+        if validator is None:
+            return
+        g.etag = make_etag(request.full_path, validator)
+        if request.if_none_match.contains_weak(g.etag):
+            response = Response(status=304)
+            response.set_etag(g.etag, weak=True)
+            return response
+
+    @bp.after_request
+    def add_etag(response: Response):
+        etag = g.pop('etag', None)
+        if etag and response.status_code == 200:
+            # the body differs with the encoding, so the tag is weak
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            # the app of the pages without an app in the URL is chosen by a cookie
+            response.vary.add('Cookie')
+        return compress_response(response)
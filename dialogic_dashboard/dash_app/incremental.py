@@ -0,0 +1,174 @@
+import datetime
+import logging
+
+from contextlib import contextmanager
+
+import attr
+import pymongo
+
+from bson import ObjectId
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# documents younger than this are left for the next run, because bots generate `_id`s on their side
+# and a slightly older `_id` may still arrive after a newer one
+SETTLE_SECONDS = 5
+# a worker that has not finished its batch in this time is considered dead, and the batch is processed again
+LEASE_SECONDS = 900
+# requests only process small batches inline; the backlog is built in the background (see `builder.py`)
+REQUEST_BATCH_SIZE = 10000
+
+
+def side_collection(logs_coll: Collection, suffix) -> Collection:
+    return logs_coll.database.get_collection(f'{logs_coll.name}_{suffix}')
+
+
+def settled_bound() -> ObjectId:
+    """ The smallest `_id` that is too young to be processed """
+    return ObjectId.from_datetime(datetime.datetime.utcnow() - datetime.timedelta(seconds=SETTLE_SECONDS))
+
+
+def newest_settled_id(logs_coll: Collection, after=None):
+    id_range = {'$lt': settled_bound()}
+    if after is not None:
+        id_range['$gt'] = after
+    newest = logs_coll.find_one({'_id': id_range}, projection={'_id': True}, sort=[('_id', pymongo.DESCENDING)])
+    return newest['_id'] if newest else None
+
+
+@attr.s()
+class Batch:
+    """ A leased range of log documents; its `id` is the same each time the range is processed again """
+    job = attr.ib()
+    match: dict = attr.ib()
+    id: ObjectId = attr.ib()
+
+
+def range_end(logs_coll: Collection, low, max_size=None):
+    """ The `_id` that closes the next range after `low`: the newest settled one, or the `max_size`-th one """
+    if max_size:
+        id_range = {'$lt': settled_bound()}
+        if low is not None:
+            id_range['$gt'] = low
+        found = list(logs_coll.find(
+            {'_id': id_range}, projection={'_id': True}, sort=[('_id', pymongo.ASCENDING)], skip=max_size - 1, limit=1,
+        ))
+        if found:
+            return found[0]['_id']
+    return newest_settled_id(logs_coll, after=low)
+
+
+@contextmanager
+def claim_batch(logs_coll: Collection, job, max_size=None):
+    """
+    Lease the next range of settled log documents (at most `max_size` of them) to `job` and yield it as a `Batch`,
+    or yield None if there is nothing new or another worker holds the lease.
+    The high-water mark moves past the range only after the body has succeeded. If it fails or the worker dies,
+    the lease is dropped or expires and the same range is processed again with the same batch id,
+    so the writes of a job must not count a batch twice (see `write_in_batches`).
+    """
+    state_coll = side_collection(logs_coll, 'state')
+    state = state_coll.find_one({'_id': job}) or {}
+    now = datetime.datetime.utcnow()
+    low = state.get('watermark')
+    high = state.get('pending')
+    if high is not None and state.get('lease') and state['lease'] > now:
+        yield None
+        return
+    if high is None:
+        high = range_end(logs_coll, low, max_size)
+        if high is None:
+            yield None
+            return
+    owner = ObjectId()
+    try:
+        state_coll.update_one(
+            {'_id': job, 'watermark': low, 'owner': state.get('owner')},
+            {'$set': {'pending': high, 'lease': now + datetime.timedelta(seconds=LEASE_SECONDS), 'owner': owner}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # another worker has claimed or committed the range first
+        yield None
+        return
+    claimed = {'$lte': high}
+    if low is not None:
+        claimed['$gt'] = low
+    try:
+        yield Batch(job=job, match={'_id': claimed}, id=high)
+    except BaseException:
+        try:
+            state_coll.update_one({'_id': job, 'owner': owner}, {'$unset': {'lease': True}})
+        except PyMongoError:
+            logger.exception(f'Could not release the lease of {job} on {logs_coll.name}')
+        raise
+    state_coll.update_one(
+        {'_id': job, 'owner': owner},
+        {'$set': {'watermark': high}, '$unset': {'pending': True, 'lease': True, 'owner': True}},
+    )
+
+
+def job_watermarks(logs_coll: Collection):
+    """ The committed high-water marks of all the jobs of the log collection """
+    return {
+        state['_id']: state.get('watermark')
+        for state in side_collection(logs_coll, 'state').find({}, projection={'watermark': True})
+    }
+
+
+def data_version(logs_coll: Collection):
+    """
+    A value that changes whenever a page built from the logs and the stores may change:
+    with each new settled log document and with each batch committed by a job.
+    A store that is being written is not committed yet, so what is read from it is never tagged as final.
+    """
+    return [newest_settled_id(logs_coll), sorted(job_watermarks(logs_coll).items())]
+
+
+def has_backlog(logs_coll: Collection, job, size=REQUEST_BATCH_SIZE):
+    """ Whether at least `size` settled log documents are still waiting for `job`, i.e. its store is being built """
+    state = side_collection(logs_coll, 'state').find_one({'_id': job}) or {}
+    id_range = {'$lt': settled_bound()}
+    if state.get('watermark') is not None:
+        id_range['$gt'] = state['watermark']
+    return logs_coll.count_documents({'_id': id_range}, limit=size) >= size
+
+
+def reset_job(logs_coll: Collection, job):
+    side_collection(logs_coll, 'state').delete_one({'_id': job})
+
+
+def bulk_upsert(coll: Collection, requests):
+    """ Execute unordered upserts and return the indices of the requests that inserted a new document. """
+    if not requests:
+        return set()
+    try:
+        result = coll.bulk_write(requests, ordered=False)
+        return set(result.upserted_ids.keys())
+    except BulkWriteError as e:
+        # the document was inserted by a previous attempt of the same batch
+        if any(err.get('code') != 11000 for err in e.details.get('writeErrors', [])):
+            raise
+        return {item['index'] for item in e.details.get('upserted', [])}
+
+
+def batch_guard(key, batch: Batch):
+    """
+    A filter for an upsert that applies the updates of a batch to a document at most once;
+    the update must also `$set` the `batch` field to `batch.id`.
+    When the batch is processed again, the document no longer matches and the upsert fails with a duplicate key,
+    which `write_in_batches` ignores.
+    """
+    return {'_id': key, 'batch': {'$ne': batch.id}}
+
+
+def write_in_batches(coll: Collection, requests, batch_size=1000):
+    batch = []
+    for req in requests:
+        batch.append(req)
+        if len(batch) >= batch_size:
+            bulk_upsert(coll, batch)
+            batch = []
+    bulk_upsert(coll, batch)
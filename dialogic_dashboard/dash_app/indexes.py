@@ -0,0 +1,221 @@
+import datetime
+import logging
+import threading
+
+import attr
+import pymongo
+
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+from .app_config import AppConfig
+from .cohorts import EPOCH, activity_coll, cohorts_pipeline
+from .handler_stats import handler_days_coll
+from .incremental import side_collection
+from .pairs import COMPLETE, pairs_coll
+from .rollups import get_day_range, hourly_pipeline, rolled_up_pipeline
+from .sampler import POOL_SIZE, pool_pipeline
+from .session_index import session_handlers_pipeline, sessions_coll
+from .user_index import users_coll
+from .views import unique_requests_pipeline
+
+logger = logging.getLogger(__name__)
+
+ASC = pymongo.ASCENDING
+DESC = pymongo.DESCENDING
+
+# $sample reads a random cursor only when it takes less than 5% of the collection
+SAMPLE_SCAN_FACTOR = 20
+
+
+@attr.s()
+class IndexSpec:
+    keys: list = attr.ib()
+    used_by: str = attr.ib()
+    suffix: str = attr.ib(default=None)  # side collection suffix; None means the log collection itself
+    options: dict = attr.ib(factory=dict)
+
+
+INDEXES = [
+    IndexSpec([('from_user', ASC), ('timestamp', ASC)], used_by='time_series'),
+    IndexSpec([('request_id', ASC)], used_by='update_handler_stats'),
+    IndexSpec(
+        [('data.session.session_id', ASC), ('timestamp', DESC)], used_by='session_version, backfill_session_fields',
+    ),
+    IndexSpec([('session_id', ASC), ('timestamp', DESC)], used_by='session_version, backfill_session_fields'),
+    IndexSpec([('day', ASC)], suffix='daily_users', used_by='time_series'),
+    IndexSpec([('handler', ASC), ('day', ASC)], suffix='handler_days', used_by='find_handler_trend'),
+    IndexSpec([('last_day', ASC)], suffix='activity', used_by='find_cohorts'),
+    IndexSpec([('latest', DESC), ('_id', DESC)], suffix='sessions', used_by='find_sessions'),
+    IndexSpec([('user_id', ASC), ('latest', DESC), ('_id', DESC)], suffix='sessions', used_by='find_sessions'),
+    IndexSpec([('rnd', ASC)], suffix='sessions', used_by='random_session'),
+    IndexSpec([('last_time', DESC), ('_id', DESC)], suffix='users', used_by='find_users'),
+    IndexSpec([('timestamp', DESC), ('_id', DESC)], suffix='pairs', used_by='find_pairs'),
+    IndexSpec(
+        [('session_id', ASC), ('timestamp', DESC), ('_id', DESC)], suffix='pairs', used_by='find_pairs',
+    ),
+    IndexSpec([('user_id', ASC), ('timestamp', DESC), ('_id', DESC)], suffix='pairs', used_by='find_pairs'),
+    IndexSpec(
+        [('handler', ASC), ('timestamp', DESC), ('_id', DESC)], suffix='pairs',
+        used_by='find_pairs, find_unique_requests',
+    ),
+]
+
+
+def text_index(config: AppConfig) -> IndexSpec:
+    return IndexSpec(
+        [('text', 'text')], used_by='search_text', options={'default_language': config.text_index_language},
+    )
+
+
+def index_specs(config: AppConfig):
+    return [text_index(config)] + INDEXES
+
+
+def ensure_indexes(logs_coll: Collection, config: AppConfig):
+    for spec in index_specs(config):
+        coll = side_collection(logs_coll, spec.suffix) if spec.suffix else logs_coll
+        try:
+            coll.create_index(spec.keys, background=True, **spec.options)
+        except PyMongoError as e:
+            logger.warning(f'Could not create index {spec.keys} on {coll.name} (used by {spec.used_by}): {e}')
+
+
+def ensure_indexes_in_background(logs_map, configs):
+    """ Create the declared indexes for all configs that ask for it, without blocking the app startup """
+    def run():
+        for k, logs_coll in logs_map.items():
+            if configs[k].create_indexes:
+                ensure_indexes(logs_coll, configs[k])
+    thread = threading.Thread(target=run, name='ensure-indexes', daemon=True)
+    thread.start()
+    return thread
+
+
+@attr.s()
+class PlanCheck:
+    """ A query of a dashboard view to explain: an aggregation pipeline, or a find() with a filter and a sort """
+    name: str = attr.ib()
+    coll: Collection = attr.ib()
+    pipeline: list = attr.ib(default=None)
+    filter: dict = attr.ib(default=None)
+    sort: list = attr.ib(default=None)
+
+    def explain(self):
+        if self.pipeline is None:
+            return self.coll.find(self.filter, sort=self.sort, limit=1).explain()
+        return self.coll.database.command(
+            'explain', {'aggregate': self.coll.name, 'pipeline': self.pipeline, 'cursor': {}}, verbosity='queryPlanner',
+        )
+
+
+def keyset_sort(key):
+    return [(key, DESC), ('_id', DESC)]
+
+
+def plan_checks(logs_coll: Collection):
+    """ The queries of the dashboard views, built by the same functions as in the views, with sample arguments """
+    handler = logs_coll.find_one({'handler': {'$exists': True}, 'from_user': False}) or {}
+    message = logs_coll.find_one({'from_user': True}) or {}
+    session_id = message.get('session_id') or (message.get('data') or {}).get('session', {}).get('session_id')
+    user_id = message.get('user_id')
+    handler_name = handler.get('handler')
+    # a recent range, as the pages usually ask for
+    end = datetime.datetime.utcnow()
+    start = end - datetime.timedelta(days=30)
+    day_range = get_day_range(start, end)
+    checks = [
+        PlanCheck('find_unique_requests', pairs_coll(logs_coll), pipeline=unique_requests_pipeline(handler_name)),
+        PlanCheck('time_series (hour)', logs_coll, pipeline=hourly_pipeline('users', start, end)),
+        PlanCheck('time_series (week, messages)', *rolled_up_pipeline(logs_coll, 'messages', day_range, 'week')),
+        PlanCheck('time_series (week, users)', *rolled_up_pipeline(logs_coll, 'users', day_range, 'week')),
+        PlanCheck('find_cohorts', activity_coll(logs_coll), pipeline=cohorts_pipeline(
+            'week', (start.date() - EPOCH).days,
+        )),
+        PlanCheck('backfill_session_fields', logs_coll, pipeline=session_handlers_pipeline([session_id])),
+        PlanCheck(
+            'session_version', logs_coll,
+            filter={'$or': [{'data.session.session_id': session_id}, {'session_id': session_id}]},
+            sort=[('timestamp', DESC)],
+        ),
+        PlanCheck('random_session', sessions_coll(logs_coll), filter={'rnd': {'$gte': 0.5}}, sort=[('rnd', ASC)]),
+        PlanCheck(
+            'random_session (handler)', sessions_coll(logs_coll),
+            filter={'handlers': handler_name, 'rnd': {'$gte': 0.5}}, sort=[('rnd', ASC)],
+        ),
+        PlanCheck(
+            'search_text', logs_coll,
+            filter={'$text': {'$search': message.get('text') or 'test'}, 'from_user': True},
+            sort=[('timestamp', DESC)],
+        ),
+        PlanCheck('find_sessions', sessions_coll(logs_coll), filter={}, sort=keyset_sort('latest')),
+        PlanCheck(
+            'find_sessions (user)', sessions_coll(logs_coll), filter={'user_id': user_id}, sort=keyset_sort('latest'),
+        ),
+        PlanCheck('find_users', users_coll(logs_coll), filter={}, sort=keyset_sort('last_time')),
+        PlanCheck(
+            'find_handler_trend', handler_days_coll(logs_coll), filter={'handler': handler_name}, sort=[('day', ASC)],
+        ),
+        PlanCheck(
+            'find_pairs (session)', pairs_coll(logs_coll),
+            filter=dict(COMPLETE, session_id=session_id), sort=keyset_sort('timestamp'),
+        ),
+        PlanCheck(
+            'find_pairs (user)', pairs_coll(logs_coll),
+            filter=dict(COMPLETE, user_id=user_id), sort=keyset_sort('timestamp'),
+        ),
+        PlanCheck(
+            'find_pairs (handler)', pairs_coll(logs_coll),
+            filter=dict(COMPLETE, handler=handler_name), sort=keyset_sort('timestamp'),
+        ),
+    ]
+    # MongoDB samples a small collection by scanning it, so the sample is checked only where that would hurt
+    if sessions_coll(logs_coll).estimated_document_count() >= SAMPLE_SCAN_FACTOR * POOL_SIZE:
+        checks.append(PlanCheck('random_session (pool)', sessions_coll(logs_coll), pipeline=pool_pipeline()))
+    return checks
+
+
+def find_stages(plan, stage):
+    if isinstance(plan, dict):
+        if plan.get('stage') == stage:
+            yield plan
+        for value in plan.values():
+            yield from find_stages(value, stage)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from find_stages(value, stage)
+
+
+@attr.s()
+class PlanReport:
+    key: str = attr.ib()
+    name: str = attr.ib()
+    status: str = attr.ib()  # ok, COLLSCAN or ERROR
+    detail: str = attr.ib(default='')
+
+    @property
+    def ok(self):
+        return self.status == 'ok'
+
+    def __str__(self):
+        return f'[{self.key}] {self.name}: {self.status} {self.detail}'.rstrip()
+
+
+def check_plans(logs_map):
+    """ Explain the query of every dashboard view; the reports of those that fall back to a full scan are not ok """
+    reports = []
+    for k, logs_coll in logs_map.items():
+        for check in plan_checks(logs_coll):
+            try:
+                plan = check.explain()
+            except PyMongoError as e:
+                report = PlanReport(k, check.name, 'ERROR', str(e))
+            else:
+                # the plan of an aggregation may be nested in its $cursor stage, so the whole explain output is searched
+                if any(find_stages(plan, 'COLLSCAN')):
+                    detail = f'on {check.coll.name} for {check.pipeline or check.filter}'
+                    report = PlanReport(k, check.name, 'COLLSCAN', detail)
+                else:
+                    report = PlanReport(k, check.name, 'ok')
+            reports.append(report)
+    return reports
@@ -0,0 +1,258 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+from collections import OrderedDict
+
+import flask_login
+
+from bson import json_util
+from flask import Blueprint, Response, current_app, render_template, request, url_for
+from flask_login import current_user
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure, PyMongoError
+
+from .pairs import pair_fields
+from .views import get_current_coll, get_logs_coll
+
+logger = logging.getLogger(__name__)
+
+bp = Blueprint('live', __name__)
+
+FILTER_FIELDS = ('handler', 'user_id', 'session_id')
+POLL_INTERVAL = 1.0
+HEARTBEAT_INTERVAL = 15
+MAX_PENDING = 10000  # requests waiting for their responses
+MAX_QUEUED = 1000  # events per client; a slower client loses the oldest ones
+POLL_BATCH_SIZE = 1000
+# each open stream holds a server thread for as long as it is open, so only a part of the threads may serve them
+MAX_STREAMS = int(os.getenv('LIVE_MAX_STREAMS', 2))
+RETRY_AFTER = 30
+
+_watchers = {}
+_lock = threading.Lock()
+
+
+def live_fields(doc):
+    """ The same fields as `PAIRING_PROJECTION`, extracted from a raw log document """
+    data = doc.get('data') or {}
+    return {
+        '_id': doc['_id'],
+        'request_id': doc.get('request_id'),
+        'from_user': doc.get('from_user'),
+        'timestamp': doc.get('timestamp'),
+        'text': doc.get('text'),
+        'user_id': doc.get('user_id'),
+        'handler': doc.get('handler'),
+        'session_id': doc.get('session_id') or (data.get('session') or {}).get('session_id'),
+        'request_type': (data.get('request') or {}).get('type'),
+        'client_id': (data.get('meta') or {}).get('client_id'),
+        'directives': (data.get('response') or {}).get('directives'),
+    }
+
+
+def matches(pair, filters):
+    return all(pair.get(k) == v for k, v in filters.items())
+
+
+class Subscription:
+    def __init__(self, filters):
+        self.filters = filters
+        self.events = queue.Queue(maxsize=MAX_QUEUED)
+
+    def push(self, event):
+        while True:
+            try:
+                self.events.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self.events.get_nowait()
+                except queue.Empty:
+                    pass
+
+
+class LiveWatcher:
+    """
+    Follow the new documents of one log collection and fan the completed request/response pairs out to subscribers.
+    A change stream is used when the server supports it (replica sets and sharded clusters);
+    on a standalone server the collection is polled for `_id` greater than the last seen one.
+    The thread runs only while somebody is subscribed.
+    """
+    def __init__(self, logs_coll: Collection, poll_interval=POLL_INTERVAL):
+        self.logs_coll = logs_coll
+        self.poll_interval = poll_interval
+        self.subscriptions = set()
+        self.pending = OrderedDict()
+        self.mode = None
+        self.last_seen = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def subscribe(self, filters=None) -> Subscription:
+        subscription = Subscription(filters or {})
+        with self.lock:
+            self.subscriptions.add(subscription)
+            if self.thread is None:
+                self.last_seen = None
+                self.thread = threading.Thread(target=self.run, name='live-watcher', daemon=True)
+                self.thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def active(self):
+        """ Whether the current thread should keep watching; the last check without subscribers stops it """
+        with self.lock:
+            if self.thread is not threading.current_thread():
+                return False
+            if not self.subscriptions:
+                self.thread = None
+                return False
+            return True
+
+    def publish(self, doc):
+        doc = live_fields(doc)
+        if not doc['request_id']:
+            return
+        pair = self.pending.pop(doc['request_id'], None) or {'_id': doc['request_id']}
+        fields, on_insert = pair_fields(doc)
+        pair.update(fields)
+        for k, v in on_insert.items():
+            pair.setdefault(k, v)
+        if 'req_id' not in pair or 'resp_id' not in pair:
+            self.pending[doc['request_id']] = pair
+            while len(self.pending) > MAX_PENDING:
+                self.pending.popitem(last=False)
+            return
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            if matches(pair, subscription.filters):
+                subscription.push(pair)
+
+    def run(self):
+        while self.active():
+            try:
+                if self.mode != 'poll':
+                    self.watch()
+                else:
+                    self.poll()
+            except OperationFailure as e:
+                if self.mode == 'poll':
+                    logger.exception(f'Could not poll {self.logs_coll.full_name}')
+                    time.sleep(self.poll_interval)
+                    continue
+                # change streams are not available on a standalone server
+                logger.info(f'Falling back to polling {self.logs_coll.full_name}: {e}')
+                self.mode = 'poll'
+            except PyMongoError:
+                logger.exception(f'The live tail of {self.logs_coll.full_name} failed, restarting')
+                time.sleep(self.poll_interval)
+
+    def watch(self):
+        pipeline = [{'$match': {'operationType': 'insert'}}]
+        with self.logs_coll.watch(pipeline, max_await_time_ms=int(self.poll_interval * 1000)) as stream:
+            self.mode = 'change_stream'
+            while self.active() and stream.alive:
+                change = stream.try_next()
+                if change is not None:
+                    self.publish(change['fullDocument'])
+
+    def poll(self):
+        if self.last_seen is None:
+            last = self.logs_coll.find_one({}, projection={'_id': True}, sort=[('_id', -1)])
+            self.last_seen = last['_id'] if last else None
+        while self.active():
+            query = {'_id': {'$gt': self.last_seen}} if self.last_seen else {}
+            docs = list(self.logs_coll.find(query, sort=[('_id', 1)], limit=POLL_BATCH_SIZE))
+            for doc in docs:
+                self.publish(doc)
+                self.last_seen = doc['_id']
+            if len(docs) < POLL_BATCH_SIZE:
+                time.sleep(self.poll_interval)
+
+
+class StreamSlots:
+    """ Count the streams open in the current process, so that they cannot take all the threads of the server """
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, limit):
+        with self.lock:
+            if self.count >= limit:
+                return False
+            self.count += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.count -= 1
+
+
+_slots = StreamSlots()
+
+
+def get_watcher(coll_key, logs_coll: Collection) -> LiveWatcher:
+    """ Return the watcher shared by all the clients of one collection in the current process """
+    key = (os.getpid(), coll_key)
+    with _lock:
+        if key not in _watchers:
+            _watchers[key] = LiveWatcher(logs_coll)
+        return _watchers[key]
+
+
+def stream_events(watcher: LiveWatcher, filters):
+    subscription = watcher.subscribe(filters)
+    try:
+        yield 'retry: 3000\n\n'
+        while True:
+            try:
+                pair = subscription.events.get(timeout=HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                # a comment line keeps the proxies from closing an idle connection
+                yield ': heartbeat\n\n'
+                continue
+            yield f'data: {json_util.dumps(pair)}\n\n'
+    finally:
+        watcher.unsubscribe(subscription)
+
+
+def get_filters():
+    return {k: request.args[k] for k in FILTER_FIELDS if request.args.get(k)}
+
+
+@bp.route('/api/live')
+@bp.route('/api/<coll_name>/live')
+@flask_login.login_required
+def api_live(coll_name=None):
+    logs_coll: Collection = get_logs_coll(current_app, current_user, coll_name=coll_name)
+    coll_key = get_current_coll(app=current_app, user=current_user, coll_name=coll_name)
+    if not _slots.acquire(current_app.config.get('LIVE_MAX_STREAMS', MAX_STREAMS)):
+        return Response(
+            'Too many live streams are open on this server, please try again later',
+            status=503, headers={'Retry-After': str(RETRY_AFTER)},
+        )
+    watcher = get_watcher(coll_key, logs_coll)
+    response = Response(
+        stream_events(watcher, get_filters()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+    # the server closes the response when the client goes away, even if the stream has not started
+    response.call_on_close(_slots.release)
+    return response
+
+
+@bp.route('/live')
+@bp.route('/<coll_name>/live')
+@flask_login.login_required
+def show_live(coll_name=None):
+    return render_template(
+        'live.html', filters=get_filters(), stream_url=url_for('live.api_live', coll_name=coll_name, **get_filters()),
+    )
@@ -0,0 +1,256 @@
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from collections import OrderedDict, defaultdict
+
+from bson import json_util
+from flask import Blueprint, Flask, Response, abort, g, has_request_context, request, template_rendered
+from flask import before_render_template
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+bp = Blueprint('metrics', __name__)
+
+SLOW_QUERY_MS = int(os.getenv('SLOW_QUERY_MS', 500))
+# run `explain` (queryPlanner verbosity, the query is not executed again) for the slow queries
+EXPLAIN_SLOW_QUERIES = os.getenv('SLOW_QUERY_EXPLAIN', '').lower() in {'1', 'true', 'yes'}
+EXPLAINABLE = {'aggregate', 'find', 'count', 'distinct'}
+IGNORED_COMMANDS = {'hello', 'isMaster', 'ismaster', 'ping', 'buildInfo', 'saslStart', 'saslContinue', 'endSessions'}
+NO_ROUTE = '-'
+SESSION_FIELDS = {'lsid', 'txnNumber', '$db', '$clusterTime', '$readPreference'}
+MAX_CURSORS = 10000  # open cursors remembered to attribute their getMore commands
+
+
+class Registry:
+    """
+    Prometheus-style counters and summaries (count and sum only), kept in the memory of the current process.
+    With several gunicorn workers each of them reports its own numbers.
+    """
+    def __init__(self):
+        self.values = defaultdict(float)
+        self.types = {}
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, suffix, labels, value, kind, description):
+        key = (name, suffix, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            self.values[key] += value
+            self.types.setdefault(name, kind)
+            self.help.setdefault(name, description)
+
+    def inc(self, name, labels, value=1.0, description=''):
+        self.add(name, '', labels, value, 'counter', description)
+
+    def observe(self, name, labels, seconds, description=''):
+        self.add(name + '_seconds', '_count', labels, 1, 'summary', description)
+        self.add(name + '_seconds', '_sum', labels, seconds, 'summary', description)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            last_name = None
+            for (name, suffix, labels), value in sorted(self.values.items()):
+                if name != last_name:
+                    if self.help[name]:
+                        lines.append(f'# HELP {name} {self.help[name]}')
+                    lines.append(f'# TYPE {name} {self.types[name]}')
+                    last_name = name
+                label_text = ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+                lines.append(f'{name}{suffix}{{{label_text}}} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def current_route():
+    if has_request_context() and request.endpoint:
+        return request.endpoint
+    return NO_ROUTE
+
+
+def shape(value):
+    """ Replace the constants of a query with placeholders, so that the same query with other values looks the same """
+    if isinstance(value, dict):
+        return {k: shape(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [shape(v) for v in value]
+    if isinstance(value, str) and value.startswith('$'):
+        return value
+    return '?'
+
+
+def fingerprint(command_name, command):
+    body = {'filter': command.get('filter'), 'pipeline': command.get('pipeline'), 'sort': command.get('sort')}
+    raw = json.dumps([command_name, shape(body)], sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:12]
+
+
+def query_body(command):
+    """ Drop the session and cluster fields that the driver adds to each command """
+    return {k: v for k, v in command.items() if k not in SESSION_FIELDS}
+
+
+def count_documents(reply):
+    cursor = reply.get('cursor')
+    if isinstance(cursor, dict):
+        return len(cursor.get('firstBatch') or cursor.get('nextBatch') or [])
+    if 'n' in reply:
+        return 1
+    return 0
+
+
+class QueryListener(monitoring.CommandListener):
+    """ Time every MongoDB command of a client and attribute it to the Flask route that issued it """
+    def __init__(self):
+        self.running = {}
+        self.cursors = OrderedDict()
+        self.lock = threading.Lock()
+        self.client = None  # set by `get_client`, used to explain the slow queries
+        self.explain_queue = queue.Queue(maxsize=100)
+        self.explain_thread = None
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        if event.command_name in IGNORED_COMMANDS:
+            return
+        command = event.command
+        if event.command_name == 'getMore':
+            # the next batches are attributed to the query that opened the cursor
+            with self.lock:
+                query = self.cursors.get(command.get('getMore'))
+            info = dict(query or {'fingerprint': None, 'collection': f'{event.database_name}.{command.get("collection")}'})
+            info.update(route=current_route(), command_name='getMore', command=None, cursor_id=command.get('getMore'))
+        else:
+            info = {
+                'route': current_route(),
+                'collection': f'{event.database_name}.{command.get(event.command_name)}',
+                'command_name': event.command_name,
+                'fingerprint': fingerprint(event.command_name, command),
+                'command': command,
+            }
+        with self.lock:
+            self.running[(event.connection_id, event.request_id)] = info
+
+    def finish(self, event, reply=None):
+        with self.lock:
+            info = self.running.pop((event.connection_id, event.request_id), None)
+            cursor = (reply or {}).get('cursor')
+            if info is not None and isinstance(cursor, dict):
+                if not cursor.get('id'):
+                    self.cursors.pop(info.get('cursor_id'), None)
+                elif info['command_name'] != 'getMore':
+                    self.cursors[cursor['id']] = info
+                    while len(self.cursors) > MAX_CURSORS:
+                        self.cursors.popitem(last=False)
+        return info
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        info = self.finish(event, event.reply)
+        if info is not None:
+            self.record(info, event.duration_micros / 1e6, count_documents(event.reply))
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        info = self.finish(event)
+        if info is not None:
+            self.record(info, event.duration_micros / 1e6, 0, failed=True)
+
+    def record(self, info, seconds, documents, failed=False):
+        labels = {
+            'route': info['route'],
+            'collection': info['collection'],
+            'command': info['command_name'],
+            'fingerprint': info['fingerprint'] or '',
+        }
+        registry.observe('dashboard_mongo_command', labels, seconds, description='Time of the MongoDB commands')
+        registry.inc('dashboard_mongo_documents_total', labels, documents, description='Documents returned by MongoDB')
+        if failed:
+            registry.inc('dashboard_mongo_failures_total', labels, description='Failed MongoDB commands')
+        if has_request_context():
+            g.mongo_seconds = g.get('mongo_seconds', 0.0) + seconds
+        if seconds * 1000 >= SLOW_QUERY_MS and info.get('command'):
+            self.log_slow_query(info, seconds, documents)
+
+    def log_slow_query(self, info, seconds, documents):
+        logger.warning(
+            f'Slow query on {info["route"]} ({seconds * 1000:.0f} ms, {documents} documents in the first batch): '
+            f'{info["collection"]} {json_util.dumps(query_body(info["command"]))}'
+        )
+        if EXPLAIN_SLOW_QUERIES and self.client is not None and info['command_name'] in EXPLAINABLE:
+            try:
+                self.explain_queue.put_nowait(info)
+            except queue.Full:
+                return
+            with self.lock:
+                if self.explain_thread is None:
+                    self.explain_thread = threading.Thread(target=self.explain_loop, name='slow-query-explain', daemon=True)
+                    self.explain_thread.start()
+
+    def explain_loop(self):
+        # MongoDB must not be queried from a listener callback, so the slow queries are explained in their own thread
+        while True:
+            info = self.explain_queue.get()
+            command = query_body(info['command'])
+            try:
+                database = self.client.get_database(info['collection'].split('.', 1)[0])
+                plan = database.command('explain', command, verbosity='queryPlanner')
+                logger.warning(f'The plan of the slow query {info["fingerprint"]}: {json_util.dumps(plan.get("queryPlanner", plan))}')
+            except Exception:
+                logger.exception(f'Could not explain the slow query {info["fingerprint"]}')
+
+
+def install_metrics(app: Flask):
+    """ Measure each request: the total time, the time of MongoDB commands, of templates and of post-processing """
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        start = g.pop('request_start', None)
+        if start is None or request.endpoint == 'metrics.show_metrics':
+            return response
+        route = current_route()
+        total = time.perf_counter() - start
+        mongo = g.get('mongo_seconds', 0.0)
+        render = g.get('render_seconds', 0.0)
+        description = 'Time of the dashboard requests'
+        registry.observe('dashboard_request', {'route': route, 'status': response.status_code}, total, description=description)
+        registry.observe('dashboard_request_mongo', {'route': route}, mongo, description='MongoDB time of the requests')
+        registry.observe('dashboard_request_render', {'route': route}, render, description='Template time of the requests')
+        registry.observe(
+            'dashboard_request_other', {'route': route}, max(total - mongo - render, 0.0),
+            description='Python time of the requests, excluding MongoDB and templates',
+        )
+        return response
+
+    def start_render(sender, template, context, **extra):
+        g.render_start = time.perf_counter()
+
+    def stop_render(sender, template, context, **extra):
+        start = g.pop('render_start', None)
+        if start is not None:
+            g.render_seconds = g.get('render_seconds', 0.0) + time.perf_counter() - start
+
+    before_render_template.connect(start_render, app, weak=False)
+    template_rendered.connect(stop_render, app, weak=False)
+    app.register_blueprint(bp)
+
+
+@bp.route('/metrics')
+def show_metrics():
+    """ The metrics require the METRICS_TOKEN bearer token; without a token, they are closed unless METRICS_PUBLIC=1 """
+    token = os.getenv('METRICS_TOKEN')
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(401)
+    elif os.getenv('METRICS_PUBLIC') != '1':
+        abort(403)
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,125 @@
+import concurrent.futures
+import logging
+import os
+import threading
+
+from collections import Counter
+
+import flask_login
+import pymongo
+
+from flask import Blueprint, abort, current_app, render_template, request
+from pymongo.collection import Collection
+
+from .app_config import AppConfig
+from .cache import ResultCache
+from .rollups import time_series
+from .views import backend_call, count_users, find_handlers
+
+logger = logging.getLogger(__name__)
+
+bp = Blueprint('overview', __name__)
+
+MAX_WORKERS = 8
+# also the longest time that a request may ask for
+DEFAULT_TIMEOUT = 10
+
+_executors = {}
+_lock = threading.Lock()
+
+
+def get_executor(max_workers=MAX_WORKERS) -> concurrent.futures.ThreadPoolExecutor:
+    """ The pool shared by the overview requests of a process, so that slow collections cannot pile up threads """
+    key = (os.getpid(), max_workers)
+    with _lock:
+        if key not in _executors:
+            _executors[key] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix='overview',
+            )
+        return _executors[key]
+
+
+def collection_overview(coll_key, logs_coll: Collection, config: AppConfig, cache: ResultCache, timeout):
+    def call(func, **kwargs):
+        return backend_call(config, cache, coll_key, logs_coll, func, **kwargs)
+
+    with pymongo.timeout(timeout):
+        handlers = call(find_handlers)
+        messages = call(time_series, field='messages')
+        users = call(time_series, field='users')
+        return {
+            'status': 'ok',
+            'handlers': len(handlers),
+            'top_handlers': [{'handler': h['_id'], 'messages': h['messages']} for h in handlers[:5]],
+            'messages': sum(messages['values']),
+            'users': call(count_users)[0],
+            'last_day': messages['indexes'][-1] if messages['indexes'] else None,
+            'messages_by_day': messages,
+            'users_by_day': users,
+        }
+
+
+def merge_series(series_list):
+    total = Counter()
+    for series in series_list:
+        for index, value in zip(series['indexes'], series['values']):
+            total[index] += value
+    indexes = sorted(total)
+    return {'indexes': indexes, 'values': [total[i] for i in indexes]}
+
+
+def collect_overview(logs_map, configs, cache: ResultCache, timeout=DEFAULT_TIMEOUT, max_workers=MAX_WORKERS):
+    """ Query all the log collections concurrently; the slow or failing ones are reported instead of awaited """
+    results = {}
+    executor = get_executor(max_workers)
+    futures = {
+        executor.submit(collection_overview, k, logs_coll, configs.get(k), cache, timeout): k
+        for k, logs_coll in logs_map.items()
+    }
+    # the queries of the collections that are not done stop at their own timeout, which frees the threads
+    done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+    for future in done:
+        k = futures[future]
+        try:
+            results[k] = future.result()
+        except Exception as e:
+            logger.exception(f'Could not collect the overview for "{k}"')
+            results[k] = {'status': 'error', 'error': str(e)}
+    for future in not_done:
+        future.cancel()
+        results[futures[future]] = {'status': 'timeout'}
+    ok = [r for r in results.values() if r['status'] == 'ok']
+    return {
+        'collections': {k: results[k] for k in logs_map if k in results},
+        'total': {
+            'complete': len(ok) == len(results),
+            'messages': sum(r['messages'] for r in ok),
+            'users': sum(r['users'] for r in ok),
+            'messages_by_day': merge_series([r['messages_by_day'] for r in ok]),
+            'users_by_day': merge_series([r['users_by_day'] for r in ok]),
+        },
+    }
+
+
+def get_overview():
+    try:
+        timeout = float(request.args.get('timeout') or DEFAULT_TIMEOUT)
+    except ValueError:
+        abort(400, 'timeout must be a number of seconds')
+    if not timeout > 0:
+        abort(400, 'timeout must be positive')
+    timeout = min(timeout, DEFAULT_TIMEOUT)
+    return collect_overview(current_app.logs_map, current_app.configs, current_app.result_cache, timeout=timeout)
+
+
+@bp.route('/api/overview')
+@flask_login.login_required
+def api_overview():
+    return get_overview()
+
+
+@bp.route('/overview')
+@flask_login.login_required
+def show_overview():
+    overview = get_overview()
+    return render_template('overview.html', overview=overview, names={k: v.name for k, v in current_app.configs.items()})
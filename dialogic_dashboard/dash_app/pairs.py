@@ -0,0 +1,71 @@
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+
+from .incremental import REQUEST_BATCH_SIZE, claim_batch, side_collection, write_in_batches
+
+PAIRING_JOB = 'pairing'
+
+# a pair is shown only when both the request and the response have been logged
+COMPLETE = {'req_id': {'$exists': True}, 'resp_id': {'$exists': True}}
+
+PAIRING_PROJECTION = {
+    'request_id': True,
+    'from_user': True,
+    'timestamp': True,
+    'text': True,
+    'user_id': True,
+    'handler': True,
+    'session_id': {'$ifNull': ['$session_id', '$data.session.session_id']},
+    'request_type': '$data.request.type',
+    'client_id': '$data.meta.client_id',
+    'directives': '$data.response.directives',
+}
+
+
+def pairs_coll(logs_coll: Collection) -> Collection:
+    return side_collection(logs_coll, 'pairs')
+
+
+def pair_fields(doc):
+    """ Return the fields that one side of a request/response pair sets, and those it sets only on insert """
+    if doc.get('from_user'):
+        fields = {
+            'req_id': doc['_id'],
+            'timestamp': doc.get('timestamp'),
+            'text': doc.get('text'),
+            'user_id': doc.get('user_id'),
+            'session_id': doc.get('session_id'),
+            'request_type': doc.get('request_type'),
+            'client_id': doc.get('client_id'),
+        }
+        return fields, {}
+    fields = {
+        'resp_id': doc['_id'],
+        'response_timestamp': doc.get('timestamp'),
+        'response_text': doc.get('text'),
+        'handler': doc.get('handler'),
+        'directives': doc.get('directives'),
+    }
+    return fields, {'user_id': doc.get('user_id'), 'session_id': doc.get('session_id')}
+
+
+def pair_update(doc):
+    """ Make an upsert that merges one side of a request/response pair into the pair document """
+    fields, on_insert = pair_fields(doc)
+    update = {'$set': fields}
+    if on_insert:
+        update['$setOnInsert'] = on_insert
+    return UpdateOne({'_id': doc['request_id']}, update, upsert=True)
+
+
+def update_pairs(logs_coll: Collection, max_size=REQUEST_BATCH_SIZE):
+    # the pairs are upserted with `$set`, so processing a batch again does no harm
+    with claim_batch(logs_coll, PAIRING_JOB, max_size) as batch:
+        if batch is None:
+            return False
+        docs = logs_coll.aggregate([
+            {'$match': dict(batch.match, request_id={'$ne': None})},
+            {'$project': PAIRING_PROJECTION},
+        ], allowDiskUse=True)
+        write_in_batches(pairs_coll(logs_coll), (pair_update(doc) for doc in docs))
+    return True
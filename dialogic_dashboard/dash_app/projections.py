@@ -0,0 +1,6 @@
+""" The fields that the pages read from the stores """
+
+
+def pair_projection(fields):
+    """ A find() projection of the documents of the pairs store """
+    return {f: True for f in set(fields) | {'timestamp'}}
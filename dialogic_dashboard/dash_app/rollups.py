@@ -0,0 +1,281 @@
+import datetime
+import math
+
+from collections import Counter, defaultdict
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+
+from .incremental import REQUEST_BATCH_SIZE, batch_guard, claim_batch, side_collection, write_in_batches
+from .sketches import HLL_RELATIVE_ERROR, HyperLogLog, merge_registers_expr
+
+ROLLUP_JOB = 'daily_rollup'
+BATCH_SIZE = 1000
+
+GRANULARITIES = {
+    'hour': datetime.timedelta(hours=1),
+    'day': datetime.timedelta(days=1),
+    'week': datetime.timedelta(days=7),
+    'month': None,  # months have different lengths, see `next_bucket`
+}
+LABEL_FORMATS = {
+    'hour': '%Y-%m-%d %H:00',
+    'day': '%Y-%m-%d',
+    'week': '%Y-%m-%d',
+    'month': '%Y-%m',
+}
+DEFAULT_HOURLY_RANGE = datetime.timedelta(days=2)
+# a longer series is refused rather than built and sent zero by zero
+MAX_BUCKETS = 10000
+
+
+def daily_coll(logs_coll: Collection) -> Collection:
+    return side_collection(logs_coll, 'daily')
+
+
+def daily_users_coll(logs_coll: Collection) -> Collection:
+    return side_collection(logs_coll, 'daily_users')
+
+
+def update_daily_rollup(logs_coll: Collection, max_size=REQUEST_BATCH_SIZE):
+    """ Roll up the next batch of new messages; return False if there was nothing to do """
+    with claim_batch(logs_coll, ROLLUP_JOB, max_size) as batch:
+        if batch is None:
+            return False
+        rows = logs_coll.aggregate([
+            {'$match': dict(batch.match, from_user=True)},
+            {"$group": {
+                "_id": {
+                    'day': {"$substr": ["$timestamp", 0, 10]},
+                    'user_id': '$user_id',
+                },
+                'count': {'$sum': 1}
+            }},
+        ], allowDiskUse=True)
+        messages = Counter()
+        sketches = defaultdict(HyperLogLog)
+        chunk = []
+        for row in rows:
+            day = row['_id']['day']
+            messages[day] += row['count']
+            sketches[day].add(row['_id'].get('user_id'))
+            chunk.append(row)
+            if len(chunk) >= BATCH_SIZE:
+                _add_daily_users(logs_coll, chunk)
+                chunk = []
+        _add_daily_users(logs_coll, chunk)
+        write_in_batches(daily_coll(logs_coll), (
+            UpdateOne(batch_guard(day, batch), [{'$set': {
+                'messages': {'$add': [{'$ifNull': ['$messages', 0]}, count]},
+                # counted anew, so that the users inserted by a failed attempt of the batch are not lost
+                'users': daily_users_coll(logs_coll).count_documents({'day': day}),
+                'hll': merge_registers_expr('hll', sketches[day].registers),
+                'batch': batch.id,
+            }}], upsert=True)
+            for day, count in messages.items()
+        ))
+    return True
+
+
+def _add_daily_users(logs_coll: Collection, rows):
+    write_in_batches(daily_users_coll(logs_coll), (
+        UpdateOne(
+            {'_id': {'day': row['_id']['day'], 'user_id': row['_id'].get('user_id')}},
+            {'$setOnInsert': {'day': row['_id']['day']}},
+            upsert=True,
+        )
+        for row in rows
+    ))
+
+
+def backfill_sketches(logs_coll: Collection, day_range):
+    # the days rolled up before sketches were introduced get them from the exact per-day user sets
+    match = {'hll': {'$exists': False}}
+    if day_range:
+        match['_id'] = day_range
+    for item in daily_coll(logs_coll).find(match, projection={'_id': True}):
+        users = daily_users_coll(logs_coll).find({'day': item['_id']}, projection={'_id': True})
+        sketch = HyperLogLog().update(u['_id'].get('user_id') for u in users)
+        daily_coll(logs_coll).update_one(
+            {'_id': item['_id']}, [{'$set': {'hll': merge_registers_expr('hll', sketch.registers)}}],
+        )
+
+
+def parse_time(value):
+    """ Parse an ISO time; a time with an offset is converted to naive UTC, like the timestamps of the logs """
+    if not value:
+        return None
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    moment = datetime.datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def check_bucket_count(start, end, granularity):
+    """ Raise ValueError if the [start, end) range has more than `MAX_BUCKETS` buckets """
+    if start is None or end is None:
+        return
+    step = GRANULARITIES[granularity] or datetime.timedelta(days=28)
+    if (end - start) / step > MAX_BUCKETS:
+        raise ValueError(f'The range is too long for granularity "{granularity}": more than {MAX_BUCKETS} points')
+
+
+def truncate(moment: datetime.datetime, granularity):
+    if granularity == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    day = datetime.datetime(moment.year, moment.month, moment.day)
+    if granularity == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def next_bucket(bucket: datetime.datetime, granularity):
+    if granularity == 'month':
+        return bucket.replace(year=bucket.year + bucket.month // 12, month=bucket.month % 12 + 1)
+    return bucket + GRANULARITIES[granularity]
+
+
+def bucket_label(bucket: datetime.datetime, granularity):
+    return bucket.strftime(LABEL_FORMATS[granularity])
+
+
+def date_trunc(date_expr, granularity):
+    trunc = {'date': date_expr, 'unit': granularity}
+    if granularity == 'week':
+        trunc['startOfWeek'] = 'monday'
+    return {'$dateTrunc': trunc}
+
+
+def parse_date_string(expr, length, fmt):
+    """ Convert a prefix of a string timestamp into a date, so that $dateTrunc can bucket it """
+    return {'$dateFromString': {
+        'dateString': {'$substrCP': [expr, 0, length]}, 'format': fmt, 'onError': None, 'onNull': None,
+    }}
+
+
+def hourly_pipeline(field, start, end):
+    # hours are not rolled up, but the range match on the indexed timestamp keeps the scan short
+    match = {'from_user': True, 'timestamp': {'$gte': str(start)}}
+    if end:
+        match['timestamp']['$lt'] = str(end)
+    bucket = date_trunc(parse_date_string('$timestamp', 19, '%Y-%m-%d %H:%M:%S'), 'hour')
+    pipeline = [{'$match': match}]
+    if field == 'users':
+        pipeline.append({'$group': {'_id': {'bucket': bucket, 'user_id': '$user_id'}}})
+        bucket = '$_id.bucket'
+    pipeline.append({'$group': {'_id': bucket, 'count': {'$sum': 1}}})
+    return pipeline
+
+
+def hourly_counts(logs_coll: Collection, field, start, end):
+    rows = logs_coll.aggregate(hourly_pipeline(field, start, end), allowDiskUse=True)
+    return {row['_id']: row['count'] for row in rows}
+
+
+def get_day_range(start, end):
+    day_range = {}
+    if start:
+        day_range['$gte'] = start.strftime('%Y-%m-%d')
+    if end:
+        # a partial last day is included as a whole
+        end_day = end if end == truncate(end, 'day') else truncate(end, 'day') + datetime.timedelta(days=1)
+        day_range['$lt'] = end_day.strftime('%Y-%m-%d')
+    return day_range
+
+
+def sketched_users(logs_coll: Collection, day_range, granularity):
+    """ Estimate distinct users per bucket by merging the daily HyperLogLog sketches """
+    backfill_sketches(logs_coll, day_range)
+    sketches = defaultdict(HyperLogLog)
+    days = daily_coll(logs_coll).find({'_id': day_range} if day_range else {}, projection={'hll': True})
+    for item in days:
+        try:
+            day = datetime.datetime.strptime(item['_id'], '%Y-%m-%d')
+        except ValueError:
+            continue
+        if item.get('hll'):
+            sketches[truncate(day, granularity)].merge(HyperLogLog(item['hll']))
+    return {bucket: sketch.count() for bucket, sketch in sketches.items()}
+
+
+def approximate_total_users(logs_coll: Collection):
+    """ Estimate the number of distinct users over the whole history, with its 95% confidence half-width """
+    update_daily_rollup(logs_coll)
+    backfill_sketches(logs_coll, None)
+    total = HyperLogLog()
+    for item in daily_coll(logs_coll).find({'hll': {'$exists': True}}, projection={'hll': True}):
+        total.merge(HyperLogLog(item['hll']))
+    count = total.count()
+    return count, int(math.ceil(1.96 * HLL_RELATIVE_ERROR * count))
+
+
+def rolled_up_counts(logs_coll: Collection, field, start, end, granularity, approx=False):
+    update_daily_rollup(logs_coll)
+    day_range = get_day_range(start, end)
+    if approx and field == 'users' and granularity != 'day':
+        return sketched_users(logs_coll, day_range, granularity)
+    coll, pipeline = rolled_up_pipeline(logs_coll, field, day_range, granularity)
+    return {row['_id']: row['count'] for row in coll.aggregate(pipeline, allowDiskUse=True)}
+
+
+def rolled_up_pipeline(logs_coll: Collection, field, day_range, granularity):
+    """ The rolled up collection to count the buckets from, and the pipeline that counts them """
+    if granularity == 'day' or field == 'messages':
+        bucket = date_trunc(parse_date_string('$_id', 10, '%Y-%m-%d'), granularity)
+        return daily_coll(logs_coll), [
+            {'$match': {'_id': day_range} if day_range else {}},
+            {'$group': {'_id': bucket, 'count': {'$sum': '$' + field}}},
+        ]
+    # distinct users of a week or a month are counted from the exact per-day user sets
+    bucket = date_trunc(parse_date_string('$day', 10, '%Y-%m-%d'), granularity)
+    return daily_users_coll(logs_coll), [
+        {'$match': {'day': day_range} if day_range else {}},
+        {'$group': {'_id': {'bucket': bucket, 'user_id': '$_id.user_id'}}},
+        {'$group': {'_id': '$_id.bucket', 'count': {'$sum': 1}}},
+    ]
+
+
+def time_series(logs_coll: Collection, field, start=None, end=None, granularity='day', approx=False):
+    """
+    Count messages or distinct users per hour, day, week or month in the [start, end) range.
+    Empty buckets are filled with zeros.
+    With `approx`, distinct users of weeks and months are estimated from sketches and returned with `errors`.
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f'Unknown granularity "{granularity}"')
+    start, end = parse_time(start), parse_time(end)
+    if granularity == 'hour':
+        start = start or datetime.datetime.utcnow() - DEFAULT_HOURLY_RANGE
+    check_bucket_count(start, end, granularity)
+    if granularity == 'hour':
+        counts = hourly_counts(logs_coll, field, start, end)
+    else:
+        counts = rolled_up_counts(logs_coll, field, start, end, granularity, approx=approx)
+    result = fill_buckets(counts, start, end, granularity)
+    if approx and field == 'users' and granularity not in {'hour', 'day'}:
+        result['errors'] = [int(math.ceil(1.96 * HLL_RELATIVE_ERROR * v)) for v in result['values']]
+    return result
+
+
+def fill_buckets(counts, start, end, granularity):
+    """ Label the buckets from `start` (or the first count) to `end` (or the last count), with zeros for the gaps """
+    counts = {k: v for k, v in counts.items() if k is not None}
+    if not counts and not (start and end):
+        return {'indexes': [], 'values': []}
+    bucket = truncate(start or min(counts), granularity)
+    last = end or next_bucket(max(counts), granularity)
+    check_bucket_count(bucket, last, granularity)
+    indexes = []
+    values = []
+    while bucket < last:
+        indexes.append(bucket_label(bucket, granularity))
+        values.append(counts.get(bucket, 0))
+        bucket = next_bucket(bucket, granularity)
+    return {
+        'indexes': indexes,
+        'values': values,
+    }
@@ -0,0 +1,94 @@
+import os
+import random
+import threading
+import time
+
+from pymongo.collection import Collection
+
+from .session_index import sessions_coll
+
+# the sessions kept in memory for each log collection, and how often they are sampled anew
+POOL_SIZE = 1000
+POOL_TTL = 300
+POOL_PROJECTION = {'_id': True, 'first_time': True, 'latest': True, 'len': True, 'handlers': True}
+
+_samplers = {}
+_lock = threading.Lock()
+
+
+def session_filters(handler=None, start=None, end=None, min_len=None):
+    """ A filter of the sessions store: the sessions of the handler, overlapping [start, end), of at least `min_len` """
+    filters = {}
+    if handler:
+        filters['handlers'] = handler
+    if start:
+        filters['latest'] = {'$gte': start}
+    if end:
+        filters['first_time'] = {'$lt': end}
+    if min_len:
+        filters['len'] = {'$gte': min_len}
+    return filters
+
+
+def matches(session, handler=None, start=None, end=None, min_len=None):
+    """ The same as `session_filters`, checked on a session document in memory """
+    return (
+        (not handler or handler in (session.get('handlers') or []))
+        and (not start or (session.get('latest') or '') >= start)
+        and (not end or (session.get('first_time') or '') < end)
+        and (not min_len or (session.get('len') or 0) >= min_len)
+    )
+
+
+def pool_pipeline(size=POOL_SIZE):
+    return [{'$sample': {'size': size}}, {'$project': POOL_PROJECTION}]
+
+
+class SessionSampler:
+    """
+    Pick random sessions from a pool sampled from the sessions store, which is refreshed every `ttl` seconds.
+    If no session of the pool matches the filters, one is found by the indexed random key of the sessions.
+    """
+    def __init__(self, logs_coll: Collection, size=POOL_SIZE, ttl=POOL_TTL):
+        self.logs_coll = logs_coll
+        self.size = size
+        self.ttl = ttl
+        self.pool = []
+        self.refreshed = 0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        coll = sessions_coll(self.logs_coll)
+        self.pool = list(coll.aggregate(pool_pipeline(self.size)))
+        self.refreshed = time.monotonic()
+
+    def sample(self, **filters):
+        """ Return the id of a random session that matches the filters, or None if there are no such sessions """
+        # one request refreshes an expired pool, the concurrent ones use the old pool meanwhile
+        if time.monotonic() - self.refreshed > self.ttl and self.lock.acquire(blocking=False):
+            try:
+                self.refresh()
+            finally:
+                self.lock.release()
+        pool = self.pool
+        candidates = [s for s in pool if matches(s, **filters)] if any(filters.values()) else pool
+        if candidates:
+            return random.choice(candidates)['_id']
+        return self.find_random(session_filters(**filters))
+
+    def find_random(self, filters):
+        coll = sessions_coll(self.logs_coll)
+        r = random.random()
+        found = coll.find_one(dict(filters, rnd={'$gte': r}), projection={'_id': True}, sort=[('rnd', 1)])
+        if found is None:
+            found = coll.find_one(dict(filters, rnd={'$lt': r}), projection={'_id': True}, sort=[('rnd', -1)])
+        return found['_id'] if found else None
+
+
+def get_sampler(coll_key, logs_coll: Collection) -> SessionSampler:
+    """ Return the sampler shared by all the requests to one collection in the current process """
+    key = (os.getpid(), coll_key)
+    with _lock:
+        if key not in _samplers:
+            _samplers[key] = SessionSampler(logs_coll)
+        return _samplers[key]
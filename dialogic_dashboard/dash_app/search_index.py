@@ -0,0 +1,183 @@
+import os
+import re
+import sqlite3
+import threading
+
+from contextlib import closing
+
+from bson import ObjectId
+from pymongo.collection import Collection
+
+from .app_config import AppConfig
+from .incremental import newest_settled_id
+
+# documents indexed per call of `update` by the background build, and by a search request that finds the index free
+MAX_UPDATE_SIZE = 20000
+REQUEST_UPDATE_SIZE = 1000
+BACKLOG_DONE = 'done'
+
+# FTS5 stems only English itself; the words of other languages are stemmed with Snowball before indexing and search
+TOKENIZERS = {
+    'english': 'porter unicode61 remove_diacritics 2',
+}
+DEFAULT_TOKENIZER = 'unicode61 remove_diacritics 2'
+
+QUERY_TOKEN = re.compile(r'"([^"]*)"|(\S+)')
+WORD = re.compile(r'\w+')
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_stemmer(language):
+    """ The Snowball stemmer of a language that FTS5 does not stem, or None; needs the optional `snowballstemmer` """
+    if language in TOKENIZERS:
+        return None
+    import snowballstemmer
+    if language not in snowballstemmer.algorithms():
+        return None
+    return snowballstemmer.stemmer(language)
+
+
+def stem_words(words, stemmer=None):
+    if stemmer is None:
+        return words
+    return stemmer.stemWords([w.lower() for w in words])
+
+
+def to_fts_query(query: str, stemmer=None):
+    """ Convert the user query into an FTS5 expression: all words must match, "quoted phrases" and prefix* words """
+    parts = []
+    for phrase, token in QUERY_TOKEN.findall(query):
+        if phrase:
+            words = stem_words(WORD.findall(phrase), stemmer)
+            if words:
+                parts.append('"' + ' '.join(words) + '"')
+            continue
+        prefix = token.endswith('*')
+        for word in stem_words(WORD.findall(token), stemmer):
+            parts.append(f'"{word}"')
+        if prefix and parts:
+            parts[-1] += '*'
+    return ' '.join(parts)
+
+
+class SearchIndex:
+    """
+    A local SQLite FTS5 index of the message texts of one log collection.
+    For the languages in `TOKENIZERS` the texts are stemmed by FTS5, for the others by Snowball,
+    so the index keeps the stems instead of the texts.
+    """
+    def __init__(self, path, language='russian'):
+        self.path = path
+        self.tokenizer = TOKENIZERS.get(language, DEFAULT_TOKENIZER)
+        self.stemmer = get_stemmer(language)
+        stemming = language if self.stemmer else ''
+        with closing(self.connect()) as conn, conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5("
+                f"text, doc_id UNINDEXED, request_id UNINDEXED, from_user UNINDEXED, tokenize='{self.tokenizer}')"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+            found = conn.execute("SELECT value FROM state WHERE key = 'stemming'").fetchone()
+            if (found[0] if found else '') != stemming:
+                # an index built with another stemming (or before stemming) does not match the queries, so it is rebuilt
+                conn.execute("DELETE FROM messages")
+                conn.execute("DELETE FROM state")
+                conn.execute("INSERT INTO state (key, value) VALUES ('stemming', ?)", (stemming, ))
+
+    def index_text(self, text):
+        if self.stemmer is None:
+            return text
+        return ' '.join(stem_words(WORD.findall(text), self.stemmer))
+
+    def connect(self, timeout=30):
+        return sqlite3.connect(self.path, timeout=timeout)
+
+    def update(self, logs_coll: Collection, max_size=MAX_UPDATE_SIZE, wait=True):
+        """
+        Index up to `max_size` log documents: first the ones newer than the indexed range, then the older history,
+        newest first, so that the recent messages are searchable long before the backlog is done.
+        Return the number of indexed documents; without `wait`, return 0 at once if another process is indexing.
+        """
+        settled = newest_settled_id(logs_coll)
+        if settled is None:
+            return 0
+        with closing(self.connect(timeout=30 if wait else 0)) as conn:
+            # the immediate transaction makes concurrent workers feed the index one after another
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+            except sqlite3.OperationalError:
+                if wait:
+                    raise
+                return 0
+            state = dict(conn.execute("SELECT key, value FROM state").fetchall())
+            if 'watermark' in state:
+                # the indexes built oldest first have no backlog
+                state = {'high': state['watermark'], 'low': BACKLOG_DONE}
+                conn.execute("DELETE FROM state WHERE key = 'watermark'")
+            new_docs = []
+            if 'high' in state:
+                high = ObjectId(state['high'])
+                new_docs = self.fetch(logs_coll, {'$gt': high, '$lte': settled}, 1, max_size)
+            if len(new_docs) == max_size:
+                high = new_docs[-1]['_id']
+            elif 'high' not in state or settled > high:
+                high = settled
+            low = state.get('low')
+            old_docs = []
+            if low != BACKLOG_DONE and len(new_docs) < max_size:
+                # `low` is the oldest indexed document, all the documents from it to `high` are indexed
+                id_range = {'$lt': ObjectId(low)} if low else {'$lte': high}
+                old_docs = self.fetch(logs_coll, id_range, -1, max_size - len(new_docs))
+                if len(old_docs) < max_size - len(new_docs):
+                    low = BACKLOG_DONE
+                else:
+                    low = str(old_docs[-1]['_id'])
+            conn.executemany(
+                "INSERT INTO messages (text, doc_id, request_id, from_user) VALUES (?, ?, ?, ?)",
+                [
+                    (self.index_text(d['text']), str(d['_id']), d.get('request_id'), int(bool(d.get('from_user'))))
+                    for d in new_docs + old_docs
+                ],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                [(k, v) for k, v in [('high', str(high)), ('low', low)] if v is not None],
+            )
+            conn.commit()
+        return len(new_docs) + len(old_docs)
+
+    @staticmethod
+    def fetch(logs_coll: Collection, id_range, direction, limit):
+        return list(logs_coll.find(
+            {'_id': id_range, 'text': {'$type': 'string'}},
+            projection={'text': True, 'request_id': True, 'from_user': True},
+            sort=[('_id', direction)],
+            limit=limit,
+        ))
+
+    def search(self, query, from_user=True, page=0, page_size=100):
+        """ Return the best matches as dicts with `doc_id`, `request_id` and bm25 `score` (lower is better) """
+        fts_query = to_fts_query(query, self.stemmer)
+        if not fts_query:
+            return []
+        with closing(self.connect()) as conn:
+            rows = conn.execute(
+                "SELECT doc_id, request_id, bm25(messages) AS score FROM messages "
+                "WHERE messages MATCH ? AND from_user = ? ORDER BY score LIMIT ? OFFSET ?",
+                (fts_query, int(bool(from_user)), page_size, page * page_size),
+            ).fetchall()
+        return [{'doc_id': ObjectId(doc_id), 'request_id': request_id, 'score': score} for doc_id, request_id, score in rows]
+
+
+def get_search_index(config: AppConfig) -> SearchIndex:
+    directory = config.search_index_dir or os.getenv('SEARCH_INDEX_DIR', 'search_index')
+    path = os.path.join(directory, f'{config.id}.sqlite')
+    language = config.search_language or config.text_index_language
+    with _lock:
+        if path not in _indexes:
+            os.makedirs(directory, exist_ok=True)
+            _indexes[path] = SearchIndex(path, language=language)
+        return _indexes[path]
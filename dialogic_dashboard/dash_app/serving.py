@@ -0,0 +1,47 @@
+import pymongo
+
+from flask import Flask, g, request
+from pymongo.errors import PyMongoError
+
+# streaming endpoints may legitimately run longer than a single query
+TIMEOUT_EXEMPT_BLUEPRINTS = {'export', 'live'}
+
+
+def install_query_timeout(app: Flask, timeout_ms):
+    """ Limit the total time that the MongoDB operations of one request may take (sets maxTimeMS on each of them) """
+    @app.before_request
+    def start_query_timeout():
+        if request.blueprint in TIMEOUT_EXEMPT_BLUEPRINTS:
+            return
+        g.query_timeout = pymongo.timeout(timeout_ms / 1000)
+        g.query_timeout.__enter__()
+
+    @app.teardown_request
+    def stop_query_timeout(exc=None):
+        ctx = g.pop('query_timeout', None)
+        if ctx is not None:
+            ctx.__exit__(None, None, None)
+
+    @app.errorhandler(PyMongoError)
+    def handle_query_timeout(e):
+        if e.timeout:
+            return f'The database did not answer within {timeout_ms} ms, please try again later', 504
+        raise e
+
+
+def serve(app_factory, host='0.0.0.0', port=5000, workers=2, threads=4, timeout=120):
+    """ Run the app with gunicorn; each worker builds its own app (and MongoDB clients) after fork """
+    from gunicorn.app.base import BaseApplication
+
+    class DashboardApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{host}:{port}')
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('timeout', timeout)
+
+        def load(self):
+            return app_factory()
+
+    DashboardApplication().run()
@@ -0,0 +1,117 @@
+import random
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+
+from .incremental import REQUEST_BATCH_SIZE, batch_guard, claim_batch, side_collection, write_in_batches
+
+SESSION_INDEX_JOB = 'session_index'
+SESSION_FIELDS_BACKFILL = 'session_fields_backfill'
+BACKFILL_CHUNK_SIZE = 1000
+
+SESSION_MATCH = {'$or': [{'data.session.session_id': {"$exists": True}}, {'session_id': {"$exists": True}}]}
+COMPLEX_ID = {  # https://stackoverflow.com/questions/36795528/
+    "$cond": [
+        {"$gt": ["$session_id", None]},
+        "$session_id",
+        "$data.session.session_id",
+    ]
+}
+
+
+def sessions_coll(logs_coll: Collection) -> Collection:
+    return side_collection(logs_coll, 'sessions')
+
+
+def update_session_index(logs_coll: Collection, max_size=REQUEST_BATCH_SIZE):
+    with claim_batch(logs_coll, SESSION_INDEX_JOB, max_size) as batch:
+        if batch is None:
+            return False
+        rows = logs_coll.aggregate([
+            {'$match': dict(batch.match, **SESSION_MATCH)},
+            {'$sort': {'timestamp': 1}},
+            {"$group": {
+                "_id": COMPLEX_ID,
+                "first_time": {"$min": '$timestamp'},
+                "latest": {"$max": '$timestamp'},
+                'len': {'$sum': 1},
+                'user_id': {'$first': '$user_id'},
+                'first_text': {'$first': '$text'},
+                'last_text': {'$last': '$text'},
+                'handlers': {'$addToSet': '$handler'},
+            }},
+        ], allowDiskUse=True)
+        write_in_batches(sessions_coll(logs_coll), (
+            UpdateOne(
+                batch_guard(row['_id'], batch),
+                {
+                    '$min': {'first_time': row['first_time']},
+                    '$max': {'latest': row['latest']},
+                    '$inc': {'len': row['len']},
+                    '$set': {'last_text': row['last_text'], 'batch': batch.id},
+                    '$addToSet': {'handlers': {'$each': [h for h in row['handlers'] if h is not None]}},
+                    # a random key, so that a random session can be found with the index on it
+                    '$setOnInsert': {
+                        'user_id': row['user_id'], 'first_text': row['first_text'], 'rnd': random.random(),
+                    },
+                },
+                upsert=True,
+            )
+            for row in rows
+        ))
+    return True
+
+
+def session_handlers_pipeline(session_ids):
+    """ The handlers of each of the sessions, by the indexed session ids of the logs """
+    return [
+        {'$match': {
+            '$or': [{'session_id': {'$in': session_ids}}, {'data.session.session_id': {'$in': session_ids}}],
+            'handler': {'$ne': None},
+        }},
+        {'$group': {'_id': COMPLEX_ID, 'handlers': {'$addToSet': '$handler'}}},
+    ]
+
+
+def backfill_session_fields(logs_coll: Collection, max_size=REQUEST_BATCH_SIZE):
+    """
+    Add the `handlers` and the random key to the sessions indexed before they were introduced,
+    going through up to `max_size` sessions per call in the `_id` order. Return False when all the sessions are done;
+    this is remembered, because all the sessions indexed later have both fields.
+    """
+    state_coll = side_collection(logs_coll, 'state')
+    state = state_coll.find_one({'_id': SESSION_FIELDS_BACKFILL}) or {}
+    if state.get('done'):
+        return False
+    coll = sessions_coll(logs_coll)
+    position = state.get('position')
+    done = False
+    processed = 0
+    while processed < max_size and not done:
+        limit = min(BACKFILL_CHUNK_SIZE, max_size - processed)
+        sessions = list(coll.find(
+            {'_id': {'$gt': position}} if position is not None else {},
+            projection={'_id': True, 'handlers': True, 'rnd': True}, sort=[('_id', 1)], limit=limit,
+        ))
+        done = len(sessions) < limit
+        if not sessions:
+            break
+        ids = [s['_id'] for s in sessions if 'handlers' not in s or 'rnd' not in s]
+        if ids:
+            rows = logs_coll.aggregate(session_handlers_pipeline(ids), allowDiskUse=True)
+            handlers = {row['_id']: row['handlers'] for row in rows}
+            requests = []
+            for session_id in ids:
+                requests.append(UpdateOne(
+                    {'_id': session_id}, {'$addToSet': {'handlers': {'$each': handlers.get(session_id, [])}}},
+                ))
+                requests.append(UpdateOne(
+                    {'_id': session_id, 'rnd': {'$exists': False}}, {'$set': {'rnd': random.random()}},
+                ))
+            write_in_batches(coll, requests)
+        position = sessions[-1]['_id']
+        processed += len(sessions)
+    state_coll.update_one(
+        {'_id': SESSION_FIELDS_BACKFILL}, {'$set': {'position': position, 'done': done}}, upsert=True,
+    )
+    return not done
@@ -0,0 +1,82 @@
+import hashlib
+import math
+
+HLL_PRECISION = 10
+HLL_REGISTERS = 1 << HLL_PRECISION
+# the standard error of a HyperLogLog estimate with HLL_REGISTERS registers
+HLL_RELATIVE_ERROR = 1.04 / math.sqrt(HLL_REGISTERS)
+
+
+def hash64(value):
+    return int.from_bytes(hashlib.sha1(str(value).encode('utf-8')).digest()[:8], 'big')
+
+
+class HyperLogLog:
+    """ A mergeable sketch for counting distinct values; registers are stored in MongoDB as a list of small ints """
+    def __init__(self, registers=None):
+        self.registers = list(registers) if registers else [0] * HLL_REGISTERS
+
+    def add(self, value):
+        h = hash64(value)
+        idx = h >> (64 - HLL_PRECISION)
+        rest = h & ((1 << (64 - HLL_PRECISION)) - 1)
+        rank = (64 - HLL_PRECISION) - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+        return self
+
+    def merge(self, other: 'HyperLogLog'):
+        self.registers = [max(a, b) for a, b in zip(self.registers, other.registers)]
+        return self
+
+    def count(self):
+        m = HLL_REGISTERS
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+def merge_registers_expr(field, registers):
+    """ An aggregation expression for a pipeline update that merges `registers` into the sketch stored in `field` """
+    return {'$cond': [
+        {'$isArray': '$' + field},
+        {'$map': {
+            'input': {'$range': [0, HLL_REGISTERS]},
+            'as': 'i',
+            'in': {'$max': [{'$arrayElemAt': ['$' + field, '$$i']}, {'$arrayElemAt': [registers, '$$i']}]},
+        }},
+        registers,
+    ]}
+
+
+def space_saving_update(top, batch, k):
+    """
+    Merge the exact counts of a batch into a space-saving summary of the `k` most frequent keys.
+    `top` is a list of dicts with `key`, `count` and `error` (the count may exceed the true one by at most `error`),
+    `batch` maps keys to dicts with their `count` and, optionally, `first_time` and `last_time`.
+    """
+    items = {item['key']: dict(item) for item in top}
+    for key, stats in sorted(batch.items(), key=lambda kv: -kv[1]['count']):
+        item = items.get(key)
+        if item is None:
+            item = {'key': key, 'count': 0, 'error': 0}
+            if len(items) >= k:
+                # the new key takes the place of the rarest one and inherits its count as the possible error
+                rarest = min(items.values(), key=lambda i: i['count'])
+                del items[rarest['key']]
+                item['count'] = item['error'] = rarest['count']
+            items[key] = item
+        item['count'] += stats['count']
+        if stats.get('first_time') is not None:
+            item['first_time'] = min(item.get('first_time') or stats['first_time'], stats['first_time'])
+        if stats.get('last_time') is not None:
+            item['last_time'] = max(item.get('last_time') or stats['last_time'], stats['last_time'])
+    return sorted(items.values(), key=lambda i: -i['count'])
@@ -0,0 +1,39 @@
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+
+from .incremental import REQUEST_BATCH_SIZE, batch_guard, claim_batch, side_collection, write_in_batches
+
+USER_INDEX_JOB = 'user_index'
+
+
+def users_coll(logs_coll: Collection) -> Collection:
+    return side_collection(logs_coll, 'users')
+
+
+def update_user_index(logs_coll: Collection, max_size=REQUEST_BATCH_SIZE):
+    with claim_batch(logs_coll, USER_INDEX_JOB, max_size) as batch:
+        if batch is None:
+            return False
+        rows = logs_coll.aggregate([
+            {'$match': dict(batch.match, user_id={"$exists": True}, from_user=True)},
+            {"$group": {
+                "_id": "$user_id",
+                "first_time": {"$min": '$timestamp'},
+                "last_time": {"$max": '$timestamp'},
+                'messages': {'$sum': 1}
+            }},
+        ], allowDiskUse=True)
+        write_in_batches(users_coll(logs_coll), (
+            UpdateOne(
+                batch_guard(row['_id'], batch),
+                {
+                    '$min': {'first_time': row['first_time']},
+                    '$max': {'last_time': row['last_time']},
+                    '$inc': {'messages': row['messages']},
+                    '$set': {'batch': batch.id},
+                },
+                upsert=True,
+            )
+            for row in rows
+        ))
+    return True
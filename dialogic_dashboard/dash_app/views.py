@@ -1,13 +1,50 @@
+import datetime
+
 from collections import OrderedDict
 
 import flask_login
 
-from flask import Blueprint, render_template, request, redirect, url_for, current_app, make_response, g
+from bson import ObjectId, json_util
+from bson.errors import InvalidId
+from flask import (
+    Blueprint, render_template, request, redirect, url_for, current_app, make_response, g, Response, abort,
+)
 from flask_login import current_user
 from pymongo.collection import Collection
 
+from .app_config import AppConfig
+from .cache import ResultCache
+from .columnar import get_columnar_store
+from .cohorts import MAX_PERIODS, find_cohorts
+from .cursors import decode_cursor, keyset_filter, keyset_find, page_links
+from .flows import END, MAX_TOP, START, find_flow
+from .handler_stats import HANDLER_STATS_JOB, TOP_K, find_handler_stats, find_handler_trend, find_top_requests
+from .http_cache import install_http_cache
+from .incremental import data_version, has_backlog, job_watermarks, settled_bound
+from .pairs import COMPLETE, PAIRING_JOB, pairs_coll, update_pairs
+from .projections import pair_projection
+from .rollups import approximate_total_users, time_series
+from .sampler import get_sampler
+from .search_index import REQUEST_UPDATE_SIZE, get_search_index
+from .session_index import sessions_coll, update_session_index
+from .user_index import update_user_index, users_coll
+
 bp = Blueprint('main', __name__)
 
+# the pages that must be rendered on every request: they set cookies, pick random data or report the cache state
+UNCACHED_ENDPOINTS = {'main.index', 'main.random_session', 'main.api_cache_stats'}
+
+# pairs rendered at once on the session and user history pages, the older ones load on scroll
+WINDOW_SIZE = 100
+
+# the fields of the pairs store that the pages render
+WINDOW_FIELDS = (
+    'timestamp', 'text', 'response_text', 'handler', 'request_type', 'directives', 'req_id', 'resp_id',
+    'client_id', 'user_id',
+)
+HANDLER_PAGE_FIELDS = ('timestamp', 'text', 'response_text', 'request_type', 'directives', 'session_id', 'user_id')
+SEARCH_FIELDS = ('timestamp', 'text', 'response_text', 'handler', 'session_id', 'user_id')
+
 
 def get_current_coll(app, user=None, coll_name=None):
     if coll_name:
@@ -30,147 +67,236 @@ def get_logs_coll(app, user=None, coll_name=None):
     return app.logs_map[coll_name]
 
 
+def cached_find(func, logs_coll: Collection, coll_name=None, **kwargs):
+    coll_key = get_current_coll(app=current_app, user=current_user, coll_name=coll_name)
+    return current_app.result_cache.call(coll_key, logs_coll, func, **kwargs)
+
+
+def backend_call(config: AppConfig, cache: ResultCache, coll_key, logs_coll: Collection, func, **kwargs):
+    """ Run an aggregation view on the storage backend of the config: MongoDB (cached) or the columnar snapshot """
+    if config is not None and config.storage_backend == 'parquet':
+        return getattr(get_columnar_store(config), func.__name__)(logs_coll, **kwargs)
+    return cache.call(coll_key, logs_coll, func, **kwargs)
+
+
+def analytics_find(func, logs_coll: Collection, coll_name=None, **kwargs):
+    coll_key = get_current_coll(app=current_app, user=current_user, coll_name=coll_name)
+    config = current_app.configs.get(coll_key)
+    return backend_call(config, current_app.result_cache, coll_key, logs_coll, func, **kwargs)
+
+
+def session_version(logs_coll: Collection, session_id):
+    """
+    The newest processed message of the session; the session page shows nothing newer.
+    None until the pairs store has committed it, so that a page read from a half-written batch is not tagged.
+    """
+    newest = logs_coll.find_one(
+        {
+            '$or': [{'data.session.session_id': session_id}, {'session_id': session_id}],
+            '_id': {'$lt': settled_bound()},
+        },
+        projection={'timestamp': True}, sort=[('timestamp', -1)],
+    )
+    watermark = job_watermarks(logs_coll).get(PAIRING_JOB)
+    if newest is not None and (watermark is None or watermark < newest['_id']):
+        return None
+    return newest
+
+
+def response_validator():
+    """
+    A value that changes when the current page may change: the `data_version` of the logs and stores,
+    or the newest processed message of the session
+    """
+    if request.endpoint in UNCACHED_ENDPOINTS:
+        return None
+    if not (current_user.is_authenticated or current_app.config.get('LOGIN_DISABLED')):
+        return None
+    view_args = request.view_args or {}
+    coll_key = get_current_coll(current_app, current_user, coll_name=view_args.get('coll_name'))
+    logs_coll = get_logs_coll(current_app, current_user, coll_name=coll_key)
+    if logs_coll is None:
+        return None
+    if request.endpoint == 'main.show_session':
+        version = session_version(logs_coll, view_args['session_id'])
+        return [coll_key, version] if version is not None else None
+    version = data_version(logs_coll)
+    config = get_config(current_app, current_user, coll_name=coll_key)
+    if config is not None and config.storage_backend == 'parquet':
+        # until the snapshot catches up with the logs, the analytics pages may change without new logs
+        if get_columnar_store(config).read_state().get('watermark') != str(version[0]):
+            return None
+    if request.args.get('granularity') == 'hour' and not request.args.get('from'):
+        # the default range of the hourly charts moves with the clock
+        version.append(datetime.datetime.utcnow().strftime('%Y-%m-%d %H'))
+    return [coll_key, version]
+
+
+install_http_cache(bp, response_validator)
+
+
+def get_config(app, user=None, coll_name=None) -> AppConfig:
+    coll_name = get_current_coll(app=app, user=user, coll_name=coll_name)
+    return app.configs.get(coll_name)
+
+
+def use_approx(config: AppConfig):
+    value = request.args.get('approx')
+    if value is None:
+        return bool(config and config.approximate)
+    return value not in {'', '0', 'false'}
+
+
+def int_arg(name, default, low=0, high=None):
+    """ An integer query parameter in [low, high]; any other value aborts the request with 400 """
+    try:
+        value = int(request.args.get(name) or default)
+    except ValueError:
+        abort(400, f'{name} must be an integer')
+    if value < low or (high is not None and value > high):
+        abort(400, f'{name} must be at least {low}' + (f' and at most {high}' if high is not None else ''))
+    return value
+
+
+def cursor_arg(name):
+    """ A paging cursor from the query, checked before it gets into a cached query """
+    token = request.args.get(name)
+    if token:
+        try:
+            decode_cursor(token)
+        except ValueError as e:
+            abort(400, str(e))
+    return token
+
+
+def get_paging(default_page_size):
+    return dict(
+        page=int_arg('page', 0),
+        page_size=int_arg('page_size', default_page_size, low=1),
+        after=cursor_arg('after'),
+        before=cursor_arg('before'),
+    )
+
+
+def paging_urls(endpoint, items, key, page=0, page_size=15, after=None, before=None, **kwargs):
+    newer, older = page_links(items, key, page_size=page_size, page=page, after=after, before=before)
+    prev_url = url_for(endpoint, before=newer, page_size=page_size, **kwargs) if newer else None
+    next_url = url_for(endpoint, after=older, page_size=page_size, **kwargs) if older else None
+    return prev_url, next_url
+
+
 @bp.route('/')
 @bp.route('/app/<coll_name>')
 @flask_login.login_required
 def index(coll_name=None):
     if coll_name:
         g.current_coll = coll_name
-    resp = make_response(render_template('index.html', cc=coll_name))
+    approx = use_approx(get_config(current_app, current_user, coll_name=coll_name))
+    resp = make_response(render_template('index.html', cc=coll_name, approx=approx))
     if coll_name:
         resp.set_cookie('current_coll', coll_name)
     return resp
 
 
-def find_sessions(logs_coll: Collection, page=0, page_size=15, filters=None):
-    match = {'$or': [{'data.session.session_id': {"$exists": True}}, {'session_id': {"$exists": True}}]}
-    if filters:
-        match.update(filters)
-    complex_id = {  # https://stackoverflow.com/questions/36795528/
-        "$cond": [
-            {"$gt": ["$session_id", None]},
-            "$session_id",
-            "$data.session.session_id",
-        ]
-    }
-    agg = logs_coll.aggregate([
-        {'$match': match},
-        {"$group": {
-            "_id": complex_id,
-            "latest": {"$max": '$timestamp'},
-            'len': {'$sum': 1}
-        }},
-        {"$sort": {'latest': -1}},
-        {'$skip': page * page_size},
-        {'$limit': page_size},
-    ])
-    sessions = list(agg)
-    return sessions
+def find_sessions(logs_coll: Collection, page=0, page_size=15, filters=None, after=None, before=None):
+    update_session_index(logs_coll)
+    return keyset_find(
+        sessions_coll(logs_coll), filters, 'latest', page=page, page_size=page_size, after=after, before=before,
+        projection={'batch': False},
+    )
 
 
-def find_messages(logs_coll: Collection, page=0, page_size=1000, filters=None, time_sort=1, extra_pipe=None, get_pairs=True):
-    match = {}
+def find_pairs(
+        logs_coll: Collection, page=0, page_size=1000, filters=None, time_sort=1, after=None, before=None, fields=None,
+):
+    update_pairs(logs_coll)
+    query = dict(COMPLETE)
     if filters:
-        match.update(filters)
-    pipeline = [
-        {'$match': match},
-        {'$lookup': {
-            'from': logs_coll.name,
-            'let': {'req_id': '$request_id', 'fu': '$from_user'},
-            'pipeline': [{'$match': {
-                '$expr':
-                    {'$and':
-                        [
-                            {'$eq': ["$request_id", "$$req_id"]},
-                            {'$ne': ["$from_user", '$$fu']}
-                        ]
-                    }
-            }
-            }],
-            'as': 'paired'
-        }},
-        {'$unwind': '$paired'},
-    ]
-    if extra_pipe:
-        pipeline.extend(extra_pipe)
-    pipeline.extend([
-        {"$sort": {'timestamp': -1}},
-        {'$skip': page * page_size},
-        {'$limit': page_size},
-        {"$sort": {'timestamp': time_sort}},
-    ])
-    agg = logs_coll.aggregate(pipeline)
-    messages = list(agg)
-    if get_pairs:
-        for m in messages:
-            m['response_text'] = m['paired']['text'] if m.get('paired') and m['paired'].get('text') else None
-            if not m.get('from_user'):
-                m['response_text'], m['text'] = m['text'], m['response_text']
-                m['data_req'] = m['paired'].get('data')
-                m['data_resp'] = m.get('data')
-            else:
-                m['data_req'] = m.get('data')
-                m['data_resp'] = m['paired'].get('data')
-            if not m.get('handler') and m['paired'].get('handler'):
-                m['handler'] = m['paired']['handler']
-
-    # add request types in Alice messages
-    for m in messages:
-        if not m.get('request_type'):
-            req_data = m.get('data_req')
-            if isinstance(req_data, dict):
-                r = req_data.get('request')
-                if isinstance(r, dict):
-                    m['request_type'] = r.get('type')
-        if not m.get('directives'):
-            resp_data = m.get('data_resp')
-            if isinstance(resp_data, dict):
-                r = resp_data.get('response')
-                if isinstance(r, dict):
-                    m['directives'] = r.get('directives')
-
-        if 'session_id' not in m:
-            m['session_id'] = None
-            if isinstance(m['data'], dict):
-                m['session_id'] = m['data'].get('session', {}).get('session_id')
+        query.update(filters)
+    messages = keyset_find(
+        pairs_coll(logs_coll), query, 'timestamp', page=page, page_size=page_size, after=after, before=before,
+        projection=pair_projection(fields) if fields else None,
+    )
+    if time_sort == 1:
+        messages.reverse()
     return messages
 
 
-def find_users(logs_coll: Collection, page=0, page_size=15, filters=None):
-    match = {'user_id': {"$exists": True}, 'from_user': True}
-    if filters:
-        match.update(filters)
-    agg = logs_coll.aggregate([
+def unique_requests_pipeline(handler_name, page=0, page_size=100, after=None, before=None):
+    match = dict(COMPLETE)
+    match['handler'] = handler_name
+    pipeline = [
         {'$match': match},
         {"$group": {
-            "_id": "$user_id",
+            "_id": '$text',
             "first_time": {"$min": '$timestamp'},
             "last_time": {"$max": '$timestamp'},
-            'messages': {'$sum': 1}
+            'count': {'$sum': 1}
         }},
-        {"$sort": {'last_time': -1}},
-        {'$skip': page * page_size},
-        {'$limit': page_size},
-    ])
-    return list(agg)
+    ]
+    direction = 1 if before else -1
+    if after or before:
+        pipeline.append({'$match': keyset_filter('last_time', after or before, older=bool(after))})
+    pipeline.append({"$sort": OrderedDict([('last_time', direction), ('_id', direction)])})
+    if not (after or before):
+        pipeline.append({'$skip': page * page_size})
+    pipeline.append({'$limit': page_size})
+    return pipeline
+
+
+def find_unique_requests(logs_coll: Collection, handler_name, page=0, page_size=100, after=None, before=None):
+    update_pairs(logs_coll)
+    pipeline = unique_requests_pipeline(handler_name, page=page, page_size=page_size, after=after, before=before)
+    messages = list(pairs_coll(logs_coll).aggregate(pipeline, allowDiskUse=True))
+    if before:
+        messages.reverse()
+    return messages
 
 
-def find_handlers(logs_coll: Collection, filters=None):
-    match = {'handler': {"$exists": True}, 'from_user': False}
-    if filters:
-        match.update(filters)
-    agg = logs_coll.aggregate([
-        {'$match': match},
-        {"$group": {
-            "_id": "$handler",
-            "first_time": {"$min": '$timestamp'},
-            "last_time": {"$max": '$timestamp'},
-            "response_example": {"$last": '$text'},
-            'messages': {'$sum': 1}
-        }},
-        {"$sort": {'messages': -1}},
-    ])
-    return list(agg)
+def find_search_results(
+        logs_coll: Collection, config: AppConfig, query, from_user=True, page=0, page_size=100,
+):
+    if config.search_backend == 'sqlite':
+        index = get_search_index(config)
+        # the background build does the bulk of the indexing, a request only catches up with the last messages
+        index.update(logs_coll, max_size=REQUEST_UPDATE_SIZE, wait=False)
+        hits = index.search(query, from_user=from_user, page=page, page_size=page_size)
+        request_ids = [h['request_id'] for h in hits if h['request_id'] is not None]
+    else:
+        found = logs_coll.find(
+            {'$text': {'$search': query}, 'from_user': from_user, 'request_id': {'$ne': None}},
+            projection={'request_id': True}, sort=[('timestamp', -1)], skip=page * page_size, limit=page_size,
+        )
+        request_ids = [m['request_id'] for m in found]
+    if not request_ids:
+        return []
+    pairs = find_pairs(
+        logs_coll=logs_coll, filters={'_id': {'$in': request_ids}}, page_size=len(request_ids), fields=SEARCH_FIELDS,
+    )
+    # keep the order of the hits: by relevance for the search index, by time for the mongo text index
+    rank = {request_id: i for i, request_id in enumerate(request_ids)}
+    return sorted(pairs, key=lambda p: rank[p['_id']])
+
+
+def find_users(logs_coll: Collection, page=0, page_size=15, filters=None, after=None, before=None):
+    update_user_index(logs_coll)
+    return keyset_find(
+        users_coll(logs_coll), filters, 'last_time', page=page, page_size=page_size, after=after, before=before,
+        projection={'batch': False},
+    )
+
+
+def find_handlers(logs_coll: Collection):
+    # the totals are kept by the handler stats store, see `handler_stats.py`
+    return find_handler_stats(logs_coll)
+
+
+def count_users(logs_coll: Collection, approx=False):
+    """ Return the number of distinct users and the 95% error of the estimate (zero if exact) """
+    if approx:
+        return approximate_total_users(logs_coll)
+    update_user_index(logs_coll)
+    return users_coll(logs_coll).estimated_document_count(), 0
 
 
 @bp.route('/sessions')
@@ -178,12 +304,12 @@ def find_handlers(logs_coll: Collection, filters=None):
 @flask_login.login_required
 def list_sessions(coll_name=None):
     logs_coll: Collection = get_logs_coll(current_app, current_user, coll_name=coll_name)
-    page = int(request.args.get('page', 0))
-    page_size = int(request.args.get('page_size', 15))
-    sessions = find_sessions(logs_coll=logs_coll, page=page, page_size=page_size)
-    prev_url = url_for('main.list_sessions', page=page - 1) if page else None
-    next_url = url_for('main.list_sessions', page=page + 1)
-    return render_template('sessions.html', sessions=sessions, page=page, prev_url=prev_url, next_url=next_url)
+    paging = get_paging(default_page_size=15)
+    sessions = cached_find(find_sessions, logs_coll, coll_name=coll_name, **paging)
+    prev_url, next_url = paging_urls('main.list_sessions', sessions, 'latest', **paging)
+    return render_template(
+        'sessions.html', sessions=sessions, page=paging['page'], prev_url=prev_url, next_url=next_url,
+    )
 
 
 @bp.route('/users')
@@ -191,12 +317,15 @@ def list_sessions(coll_name=None):
 @flask_login.login_required
 def list_users(coll_name=None):
     logs_coll: Collection = get_logs_coll(current_app, current_user, coll_name=coll_name)
-    page = int(request.args.get('page', 0))
-    page_size = int(request.args.get('page_size', 15))
-    users = find_users(logs_coll=logs_coll, page=page, page_size=page_size)
-    prev_url = url_for('main.list_users', page=page - 1) if page else None
-    next_url = url_for('main.list_users', page=page + 1)
-    return render_template('users.html', users=users, page=page, prev_url=prev_url, next_url=next_url)
+    paging = get_paging(default_page_size=15)
+    users = analytics_find(find_users, logs_coll, coll_name=coll_name, **paging)
+    prev_url, next_url = paging_urls('main.list_users', users, 'last_time', **paging)
+    approx = use_approx(get_config(current_app, current_user, coll_name=coll_name))
+    total, error = analytics_find(count_users, logs_coll, coll_name=coll_name, approx=approx)
+    return render_template(
+        'users.html', users=users, page=paging['page'], prev_url=prev_url, next_url=next_url,
+        total=total, error=error, approx=approx,
+    )
 
 
 @bp.route('/session/<session_id>')
@@ -204,30 +333,78 @@ def list_users(coll_name=None):
 @flask_login.login_required
 def show_session(session_id, coll_name=None):
     logs_coll: Collection = get_logs_coll(current_app, current_user, coll_name=coll_name)
-    messages = find_messages(logs_coll=logs_coll, filters={
-        '$or': [{'data.session.session_id': session_id}, {'session_id': session_id}],
-        'from_user': True
-    })
+    messages, older = find_window(logs_coll, filters={'session_id': session_id})
     if not messages:
         return f'Session "{session_id}" not found', 404
     sess = messages[0]
-    sess_data = sess.get('data')
-    if isinstance(sess_data, dict):
-        device = sess_data.get('meta', {}).get('client_id')
-    else:
-        device = None
     return render_template(
-        'session.html', messages=messages, session_id=session_id, device=device, user_id=sess['user_id']
+        'session.html', messages=messages, session_id=session_id, device=sess.get('client_id'), user_id=sess['user_id'],
+        older_url=window_url(coll_name, older, session_id=session_id, details=1), details=True,
     )
 
 
+def find_window(logs_coll: Collection, filters, after=None, page_size=WINDOW_SIZE):
+    """ Return one window of pairs in the chronological order, and the cursor to the older window """
+    messages = find_pairs(
+        logs_coll=logs_coll, filters=filters, time_sort=-1, page_size=page_size, after=after, fields=WINDOW_FIELDS,
+    )
+    _, older = page_links(messages, 'timestamp', page_size=page_size, after=after)
+    messages.reverse()
+    return messages, older
+
+
+def window_url(coll_name, older, **kwargs):
+    if not older:
+        return None
+    return url_for('main.api_pairs_window', coll_name=coll_name, after=older, **kwargs)
+
+
+@bp.route('/api/pairs')
+@bp.route('/api/<coll_name>/pairs')
+@flask_login.login_required
+def api_pairs_window(coll_name=None):
+    """ The rendered rows of an older window of a session or a user history, for the infinite scroll """
+    logs_coll: Collection = get_logs_coll(current_app, current_user, coll_name=coll_name)
+    filters = {k: request.args[k] for k in ('session_id', 'user_id') if request.args.get(k)}
+    if not filters:
+        return {'error': 'session_id or user_id is required'}, 400
+    details = request.args.get('details') == '1'
+    messages, older = find_window(
+        logs_coll, filters=filters, after=cursor_arg('after'),
+        page_size=int_arg('page_size', WINDOW_SIZE, low=1, high=WINDOW_SIZE),
+    )
+    return {
+        'html': render_template('pair_rows.html', messages=messages, details=details),
+        'older_url': window_url(coll_name, older, details=1 if details else None, **filters),
+    }
+
+
+@bp.route('/api/message/<doc_id>')
+@bp.route('/api/<coll_name>/message/<doc_id>')
+@flask_login.login_required
+def api_raw_message(doc_id, coll_name=None):
+    """ The raw `data` of one logged request or response, loaded when the user expands it """
+    logs_coll: Collection = get_logs_coll(current_app, current_user, coll_name=coll_name)
+    try:
+        doc = logs_coll.find_one({'_id': ObjectId(doc_id)}, projection={'data': True})
+    except InvalidId:
+        doc = None
+    if doc is None:
+        return f'Message "{doc_id}" not found', 404
+    return Response(json_util.dumps(doc.get('data'), ensure_ascii=False, indent=2), mimetype='application/json')
+
+
 @bp.route('/handlers')
 @bp.route('/<coll_name>/handlers')
 @flask_login.login_required
 def list_handlers(coll_name=None):
     logs_coll: Collection = get_logs_coll(current_app, current_user, coll_name=coll_name)
-    handlers = find_handlers(logs_coll=logs_coll)
-    return render_template('handlers.html', handlers=handlers)
+    handlers = analytics_find(find_handlers, logs_coll, coll_name=coll_name)
+    config = get_config(current_app, current_user, coll_name=coll_name)
+    # the parquet snapshot is queried as a whole, the handler stats store only for the mongo backend
+    mongo = config is None or config.storage_backend != 'parquet'
+    building = mongo and has_backlog(logs_coll, HANDLER_STATS_JOB)
+    return render_template('handlers.html', handlers=handlers, building=building)
 
 
 @bp.route('/handler/<handler_name>')
@@ -235,22 +412,19 @@ def list_handlers(coll_name=None):
 @flask_login.login_required
 def show_handler(handler_name, coll_name=None):
     logs_coll: Collection = get_logs_coll(current_app, current_user, coll_name=coll_name)
-    page = int(request.args.get('page', 0))
-    page_size = int(request.args.get('page_size', 100))
-    messages = find_messages(
-        logs_coll=logs_coll, filters={'handler': handler_name, 'from_user': False}, time_sort=-1,
-        page=page, page_size=page_size
+    paging = get_paging(default_page_size=100)
+    messages = find_pairs(
+        logs_coll=logs_coll, filters={'handler': handler_name}, time_sort=-1, fields=HANDLER_PAGE_FIELDS, **paging,
     )
     if not messages:
-        if not page:
+        if not (paging['page'] or paging['after'] or paging['before']):
             return f'Handler "{handler_name}" not found', 404
-        return f'Handler "{handler_name}" does not have page {page}', 404
-    prev_url = url_for(
-        'main.show_handler', page=page - 1, handler_name=handler_name, coll_name=coll_name
-    ) if page else None
-    next_url = url_for('main.show_handler', page=page + 1, handler_name=handler_name, coll_name=coll_name)
+        return f'Handler "{handler_name}" does not have this page', 404
+    prev_url, next_url = paging_urls(
+        'main.show_handler', messages, 'timestamp', handler_name=handler_name, coll_name=coll_name, **paging
+    )
     return render_template(
-        'by_handler.html', messages=messages, handler_name=handler_name,
+        'by_handler.html', messages=messages, handler_name=handler_name, page=paging['page'],
         prev_url=prev_url, next_url=next_url,
     )
 
@@ -260,53 +434,67 @@ def show_handler(handler_name, coll_name=None):
 @flask_login.login_required
 def show_handler_unique(handler_name, coll_name=None):
     logs_coll: Collection = get_logs_coll(current_app, current_user, coll_name=coll_name)
-    page = int(request.args.get('page', 0))
-    page_size = int(request.args.get('page_size', 100))
-    extra = [
-        {"$group": {
-            "_id": '$paired.text',
-            "first_time": {"$min": '$timestamp'},
-            "last_time": {"$max": '$timestamp'},
-            'count': {'$sum': 1}
-        }},
-    ]
-    messages = find_messages(
-        logs_coll=logs_coll, filters={'handler': handler_name, 'from_user': False}, time_sort=-1, extra_pipe=extra,
-        page=page, page_size=page_size, get_pairs=False,
-    )
+    if request.args.get('exact') != '1':
+        messages = cached_find(find_top_requests, logs_coll, coll_name=coll_name, handler_name=handler_name)
+        if messages is None:
+            return f'Handler "{handler_name}" not found', 404
+        trend = cached_find(find_handler_trend, logs_coll, coll_name=coll_name, handler_name=handler_name)
+        return render_template(
+            'by_handler_unique.html', messages=messages, handler_name=handler_name, trend=trend, top_k=TOP_K,
+        )
+    paging = get_paging(default_page_size=100)
+    messages = find_unique_requests(logs_coll=logs_coll, handler_name=handler_name, **paging)
     if not messages:
-        if not page:
+        if not (paging['page'] or paging['after'] or paging['before']):
             return f'Handler "{handler_name}" not found', 404
-        return f'Handler "{handler_name}" does not have page {page}', 404
-    prev_url = url_for(
-        'main.show_handler', page=page - 1, handler_name=handler_name, coll_name=coll_name
-    ) if page else None
-    next_url = url_for('main.show_handler_unique', page=page + 1, handler_name=handler_name, coll_name=coll_name)
+        return f'Handler "{handler_name}" does not have this page', 404
+    prev_url, next_url = paging_urls(
+        'main.show_handler_unique', messages, 'last_time', handler_name=handler_name, coll_name=coll_name,
+        exact=1, **paging
+    )
     return render_template(
-        'by_handler_unique.html', messages=messages, handler_name=handler_name,
-        prev_url=prev_url, next_url=next_url,
+        'by_handler_unique.html', messages=messages, handler_name=handler_name, page=paging['page'],
+        prev_url=prev_url, next_url=next_url, exact=True,
     )
 
 
+@bp.route('/flow')
+@bp.route('/<coll_name>/flow')
+@flask_login.login_required
+def show_flow(coll_name=None):
+    logs_coll: Collection = get_logs_coll(current_app, current_user, coll_name=coll_name)
+    handler_name = request.args.get('handler') or None
+    flow = cached_find(find_flow, logs_coll, coll_name=coll_name, handler=handler_name)
+    return render_template('flow.html', flow=flow, handler_name=handler_name, start=START, end=END)
+
+
+@bp.route('/api/flow')
+@bp.route('/api/<coll_name>/flow')
+@flask_login.login_required
+def api_flow(coll_name=None):
+    logs_coll: Collection = get_logs_coll(current_app, current_user, coll_name=coll_name)
+    top = int_arg('top', 20, low=1, high=MAX_TOP)
+    return cached_find(find_flow, logs_coll, coll_name=coll_name, handler=request.args.get('handler') or None, top=top)
+
+
 @bp.route('/session/random')
 @bp.route('/<coll_name>/session/random')
 @flask_login.login_required
 def random_session(coll_name=None):
     logs_coll: Collection = get_logs_coll(current_app, current_user, coll_name=coll_name)
-    sampled = list(logs_coll.aggregate(
-       [
-           {'$match': {'from_user': True}},
-           {'$sample': {'size': 1}},
-       ]
-    ))
-    if sampled:
-        # todo: fix the case when session is not marked in an alice-like way
-        session_id = sampled[0].get('data', {}).get('session', {}).get('session_id') or sampled[0].get('session_id')
-        if session_id is not None:
-            return show_session(session_id=session_id)
-        uid = sampled[0].get('user_id')
-        return show_user(user_id=uid)
-    return list_sessions()
+    coll_key = get_current_coll(current_app, current_user, coll_name=coll_name)
+    filters = dict(
+        handler=request.args.get('handler'),
+        start=request.args.get('from'),
+        end=request.args.get('to'),
+        min_len=int_arg('min_len', 0),
+    )
+    session_id = get_sampler(coll_key, logs_coll).sample(**filters)
+    if session_id is None:
+        if any(filters.values()):
+            return 'No session matches the filters', 404
+        return redirect(url_for('main.list_sessions', coll_name=coll_name))
+    return redirect(url_for('main.show_session', session_id=session_id, coll_name=coll_name))
 
 
 @bp.route('/user/<user_id>')
@@ -314,7 +502,9 @@ def random_session(coll_name=None):
 @flask_login.login_required
 def show_user(user_id, coll_name=None):
     logs_coll: Collection = get_logs_coll(current_app, current_user, coll_name=coll_name)
-    sessions = find_sessions(logs_coll=logs_coll, page=0, page_size=100500, filters={'user_id': user_id})
+    sessions = cached_find(
+        find_sessions, logs_coll, coll_name=coll_name, page=0, page_size=100500, filters={'user_id': user_id},
+    )
     return render_template('user.html', sessions=sessions, user_id=user_id)
 
 
@@ -323,10 +513,12 @@ def show_user(user_id, coll_name=None):
 @flask_login.login_required
 def show_user_messages(user_id, coll_name=None):
     logs_coll: Collection = get_logs_coll(current_app, current_user, coll_name=coll_name)
-    messages = find_messages(logs_coll=logs_coll, filters={'user_id': user_id, 'from_user': True})
+    messages, older = find_window(logs_coll, filters={'user_id': user_id})
     if not messages:
         return f'User "{user_id}" not found', 404
-    return render_template('user_messages.html', messages=messages, user_id=user_id)
+    return render_template(
+        'user_messages.html', messages=messages, user_id=user_id, older_url=window_url(coll_name, older, user_id=user_id),
+    )
 
 
 @bp.route('/search', methods=['GET', 'POST'])
@@ -338,11 +530,33 @@ def search_text(coll_name=None):
     from_user = bool(request.args.get('query_type') != 'res')
     if request.args and request.args.get('query'):
         query = request.args['query']
+    page = int_arg('page', 0)
+    page_size = int_arg('page_size', 100, low=1)
     if query:
-        messages = find_messages(logs_coll=logs_coll, filters={'$text': {'$search': query}, 'from_user': from_user})
+        config = get_config(current_app, current_user, coll_name=coll_name)
+        messages = find_search_results(
+            logs_coll=logs_coll, config=config, query=query, from_user=from_user, page=page, page_size=page_size,
+        )
     else:
         messages = []
-    return render_template('search.html', messages=messages, query=query)
+    args = dict(request.args)
+    prev_url = url_for('main.search_text', **dict(args, page=page - 1)) if page else None
+    next_url = url_for('main.search_text', **dict(args, page=page + 1)) if len(messages) == page_size else None
+    return render_template(
+        'search.html', messages=messages, query=query, page=page, prev_url=prev_url, next_url=next_url,
+    )
+
+
+def get_time_series(logs_coll: Collection, coll_name, field):
+    try:
+        return analytics_find(
+            time_series, logs_coll, coll_name=coll_name, field=field,
+            start=request.args.get('from'), end=request.args.get('to'),
+            granularity=request.args.get('granularity', 'day'),
+            approx=use_approx(get_config(current_app, current_user, coll_name=coll_name)),
+        )
+    except ValueError as e:
+        return {'error': str(e)}, 400
 
 
 @bp.route('/api/messages-by-day')
@@ -350,35 +564,7 @@ def search_text(coll_name=None):
 @flask_login.login_required
 def api_list_sessions(coll_name=None):
     logs_coll: Collection = get_logs_coll(current_app, current_user, coll_name=coll_name)
-    r = logs_coll.aggregate([
-        {'$match': {
-            'from_user': True,
-        }},
-        {"$group": {
-            "_id": {
-                "year": {
-                    "$substr": ["$timestamp", 0, 4]
-                },
-                "month": {
-                    "$substr": ["$timestamp", 5, 2]
-                },
-                "day": {
-                    "$substr": ["$timestamp", 8, 2]
-                }
-            },
-            'count': {'$sum': 1}
-        }},
-        {"$sort": OrderedDict([('_id.year', 1), ('_id.month', 1), ('_id.day', 1)])},
-    ])
-    indexes = []
-    values = []
-    for item in r:
-        indexes.append('-'.join([item['_id']['year'], item['_id']['month'], item['_id']['day']]))
-        values.append(item['count'])
-    return {
-        'indexes': indexes,
-        'values': values,
-    }
+    return get_time_series(logs_coll, coll_name=coll_name, field='messages')
 
 
 @bp.route('/api/users-by-day')
@@ -386,41 +572,26 @@ def api_list_sessions(coll_name=None):
 @flask_login.login_required
 def api_list_users(coll_name=None):
     logs_coll: Collection = get_logs_coll(current_app, current_user, coll_name=coll_name)
-    r = logs_coll.aggregate([
-        {'$match': {
-            'from_user': True,
-        }},
-        {"$group": {
-            "_id": {
-                "year": {
-                    "$substr": ["$timestamp", 0, 4]
-                },
-                "month": {
-                    "$substr": ["$timestamp", 5, 2]
-                },
-                "day": {
-                    "$substr": ["$timestamp", 8, 2]
-                },
-                'user_id': '$user_id',
-            },
-            'count': {'$sum': 1}
-        }},
-        {"$group": {
-            "_id": {
-                "year": '$_id.year',
-                "month": '$_id.month',
-                "day": '$_id.day',
-            },
-            'count': {'$sum': 1}
-        }},
-        {"$sort": OrderedDict([('_id.year', 1), ('_id.month', 1), ('_id.day', 1)])},
-    ])
-    indexes = []
-    values = []
-    for item in r:
-        indexes.append('-'.join([item['_id']['year'], item['_id']['month'], item['_id']['day']]))
-        values.append(item['count'])
-    return {
-        'indexes': indexes,
-        'values': values,
-    }
+    return get_time_series(logs_coll, coll_name=coll_name, field='users')
+
+
+@bp.route('/api/cohorts')
+@bp.route('/api/<coll_name>/cohorts')
+@flask_login.login_required
+def api_cohorts(coll_name=None):
+    logs_coll: Collection = get_logs_coll(current_app, current_user, coll_name=coll_name)
+    try:
+        return cached_find(
+            find_cohorts, logs_coll, coll_name=coll_name,
+            granularity=request.args.get('granularity', 'week'),
+            periods=int_arg('periods', 12, low=1, high=MAX_PERIODS),
+            start=request.args.get('from'), end=request.args.get('to'),
+        )
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+
+@bp.route('/api/cache-stats')
+@flask_login.login_required
+def api_cache_stats():
+    return current_app.result_cache.stats()
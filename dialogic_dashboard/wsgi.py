@@ -0,0 +1,4 @@
+# WSGI entry point, e.g. `gunicorn dialogic_dashboard.wsgi:app`
+from .dash_app import create_app
+
+app = create_app()
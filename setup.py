@@ -12,7 +12,7 @@ setuptools.setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     url="https://github.com/avidale/dialogic-dashboard",
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(exclude=['benchmarks', 'benchmarks.*']),
     license="MIT",
     classifiers=[
         "Development Status :: 3 - Alpha",
@@ -25,9 +25,17 @@ setuptools.setup(
         'flask',
         'flask-login',
         'flask-bootstrap',
-        'pymongo',
+        'pymongo>=4.2',
         'attrs',
     ],
+    extras_require={
+        'serve': ['gunicorn'],
+        'columnar': ['pyarrow', 'duckdb'],
+        'compression': ['brotli'],
+        'redis': ['redis'],
+        'search': ['snowballstemmer'],
+        'test': ['pytest', 'mongomock'],
+    },
     entry_points={
             "console_scripts": [
                 "dialogic_dashboard=dialogic_dashboard.__main__:main",
@@ -0,0 +1,36 @@
+import datetime
+
+import pytest
+
+from bson import ObjectId
+
+
+class LogWriter:
+    """ Writes request/response pairs into a log collection, with settled `_id`s in the order of writing """
+    def __init__(self, coll):
+        self.coll = coll
+        self.n = 0
+        self.base = int(datetime.datetime(2021, 1, 1).timestamp())
+
+    def next_id(self):
+        self.n += 1
+        return ObjectId(f'{self.base + self.n:08x}{self.n:016x}')
+
+    def turn(self, session_id, handler, timestamp, user_id='user', text='hi'):
+        request_id = f'{session_id}-{self.n}'
+        common = {'session_id': session_id, 'user_id': user_id, 'request_id': request_id}
+        self.coll.insert_many([
+            dict(common, _id=self.next_id(), from_user=True, text=text, timestamp=timestamp),
+            dict(common, _id=self.next_id(), from_user=False, text='ok', handler=handler, timestamp=timestamp + '.5'),
+        ])
+
+
+@pytest.fixture
+def db():
+    mongomock = pytest.importorskip('mongomock')
+    return mongomock.MongoClient().db
+
+
+@pytest.fixture
+def logs(db):
+    return LogWriter(db.logs)
@@ -0,0 +1,36 @@
+from dialogic_dashboard.dash_app.cohorts import find_cohorts
+
+
+def write_activity(logs):
+    # 2021-03-01 is a Monday
+    logs.turn('a1', 'hello', '2021-03-07 23:00:00', user_id='a')  # Sunday
+    logs.turn('a2', 'hello', '2021-03-08 09:00:00', user_id='a')  # Monday of the next week
+    logs.turn('b1', 'hello', '2021-03-03 12:00:00', user_id='b')
+    logs.turn('c1', 'hello', '2021-03-09 12:00:00', user_id='c')
+
+
+def test_weeks_start_on_monday(db, logs):
+    write_activity(logs)
+    result = find_cohorts(db.logs, granularity='week', periods=4)
+    assert [c['cohort'] for c in result['cohorts']] == ['2021-03-01', '2021-03-08']
+    assert result['cohorts'][0]['users'] == 2
+    # Sunday and the next Monday are different weeks
+    assert result['cohorts'][0]['returned'] == [2, 1]
+    assert result['active'] == {'indexes': ['2021-03-01', '2021-03-08'], 'new': [2, 1], 'returning': [0, 1]}
+
+
+def test_periods_that_have_not_started_are_left_out(db, logs):
+    write_activity(logs)
+    result = find_cohorts(db.logs, granularity='week', periods=4)
+    # the last cohort has only had its first week
+    assert result['cohorts'][1]['returned'] == [1]
+    assert result['cohorts'][1]['rates'] == [1.0]
+    # the second week is averaged over the first cohort only, the later weeks over none
+    assert result['retention']['values'] == [1.0, 0.5, None, None]
+
+
+def test_days_and_range(db, logs):
+    write_activity(logs)
+    result = find_cohorts(db.logs, granularity='day', periods=3, start='2021-03-08', end='2021-03-10')
+    assert [(c['cohort'], c['returned']) for c in result['cohorts']] == [('2021-03-09', [1])]
+    assert result['active'] == {'indexes': ['2021-03-08', '2021-03-09'], 'new': [0, 1], 'returning': [1, 0]}
@@ -0,0 +1,37 @@
+from unittest import mock
+
+import pytest
+
+from bson import ObjectId
+
+from dialogic_dashboard.dash_app.handler_stats import MAX_RETRIES, merge_top_requests
+from dialogic_dashboard.dash_app.incremental import Batch
+
+
+def make_batch():
+    return Batch(job='handler_stats', match={}, id=ObjectId())
+
+
+def test_merge_top_requests_once_per_batch(db):
+    coll = db.logs_handlers
+    # the handler document is upserted with the counters before the merge
+    coll.insert_one({'_id': 'help'})
+    batch = make_batch()
+    merge_top_requests(coll, 'help', {'hi': {'count': 2}}, batch)
+    # the same batch processed again after a failure later in it
+    merge_top_requests(coll, 'help', {'hi': {'count': 2}}, batch)
+    merge_top_requests(coll, 'help', {'hi': {'count': 1}, 'bye': {'count': 1}}, make_batch())
+    top = coll.find_one({'_id': 'help'})['top_requests']
+    assert [(i['key'], i['count']) for i in top] == [('hi', 3), ('bye', 1)]
+
+
+def test_merge_top_requests_fails_the_batch_on_lost_races(db):
+    coll = db.logs_handlers
+    coll.insert_one({'_id': 'help'})
+    merge_top_requests(coll, 'help', {'hi': {'count': 1}}, make_batch())
+    lost = mock.Mock(matched_count=0)
+    with mock.patch.object(type(coll), 'update_one', return_value=lost) as update_one:
+        with pytest.raises(RuntimeError):
+            merge_top_requests(coll, 'help', {'hi': {'count': 1}}, make_batch())
+    assert update_one.call_count == MAX_RETRIES
+    assert coll.find_one({'_id': 'help'})['top_requests'][0]['count'] == 1
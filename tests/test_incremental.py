@@ -0,0 +1,100 @@
+import datetime
+
+import pytest
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from dialogic_dashboard.dash_app.incremental import (
+    Batch, batch_guard, bulk_upsert, claim_batch, has_backlog, job_watermarks, side_collection, write_in_batches,
+)
+
+
+def log_ids(db):
+    return [doc['_id'] for doc in db.logs.find(sort=[('_id', 1)])]
+
+
+def test_claim_batch_commits_after_the_body(db, logs):
+    for i in range(3):
+        logs.turn(f's{i}', 'help', f'2021-01-01 00:0{i}')
+    ids = log_ids(db)
+    with claim_batch(db.logs, 'job', max_size=4) as batch:
+        assert batch.id == ids[3]
+        assert db.logs.count_documents(batch.match) == 4
+        assert job_watermarks(db.logs) == {'job': None}
+    assert job_watermarks(db.logs) == {'job': ids[3]}
+    with claim_batch(db.logs, 'job', max_size=4) as batch:
+        assert batch.id == ids[-1]
+        assert db.logs.count_documents(batch.match) == 2
+    with claim_batch(db.logs, 'job') as batch:
+        assert batch is None
+
+
+def test_claim_batch_replays_the_batch_after_a_crash(db, logs):
+    logs.turn('s', 'help', '2021-01-01 00:00')
+    with pytest.raises(RuntimeError):
+        with claim_batch(db.logs, 'job') as batch:
+            crashed = batch
+            raise RuntimeError('the worker failed')
+    assert job_watermarks(db.logs) == {'job': None}
+    # a newer message does not widen the pending range
+    logs.turn('s', 'help', '2021-01-01 00:01')
+    with claim_batch(db.logs, 'job') as batch:
+        assert batch == crashed
+    assert job_watermarks(db.logs) == {'job': crashed.id}
+
+
+def test_claim_batch_skips_a_held_lease(db, logs):
+    logs.turn('s', 'help', '2021-01-01 00:00')
+    with claim_batch(db.logs, 'job') as batch:
+        with claim_batch(db.logs, 'job') as other:
+            assert other is None
+    assert job_watermarks(db.logs) == {'job': batch.id}
+
+
+def test_claim_batch_takes_over_an_expired_lease(db, logs):
+    logs.turn('s', 'help', '2021-01-01 00:00')
+    logs.turn('s', 'help', '2021-01-01 00:01')
+    ids = log_ids(db)
+    # a worker died holding the first turn
+    side_collection(db.logs, 'state').insert_one({
+        '_id': 'job', 'watermark': None, 'pending': ids[1], 'owner': ObjectId(),
+        'lease': datetime.datetime.utcnow() - datetime.timedelta(seconds=1),
+    })
+    with claim_batch(db.logs, 'job') as batch:
+        assert batch.id == ids[1]
+        assert db.logs.count_documents(batch.match) == 2
+    assert job_watermarks(db.logs) == {'job': ids[1]}
+
+
+def counter_update(key, batch):
+    return UpdateOne(batch_guard(key, batch), {'$inc': {'n': 1}, '$set': {'batch': batch.id}}, upsert=True)
+
+
+def test_batch_guard_applies_a_batch_once(db):
+    first, second = Batch('job', {}, ObjectId()), Batch('job', {}, ObjectId())
+    write_in_batches(db.counters, [counter_update('a', first)])
+    # the replay of the batch hits a duplicate key, which is swallowed
+    write_in_batches(db.counters, [counter_update('a', first), counter_update('b', first)], batch_size=1)
+    write_in_batches(db.counters, [counter_update('a', second)])
+    assert {doc['_id']: doc['n'] for doc in db.counters.find()} == {'a': 2, 'b': 1}
+
+
+def test_bulk_upsert_reports_the_inserts(db):
+    batch = Batch('job', {}, ObjectId())
+    assert bulk_upsert(db.counters, [counter_update('a', batch)]) == {0}
+    # the duplicate key of the replayed update is swallowed, the new document is still reported
+    assert len(bulk_upsert(db.counters, [counter_update('a', batch), counter_update('b', batch)])) == 1
+    assert db.counters.count_documents({}) == 2
+    assert bulk_upsert(db.counters, []) == set()
+
+
+def test_has_backlog(db, logs):
+    for i in range(3):
+        logs.turn(f's{i}', 'help', f'2021-01-01 00:0{i}')
+    assert has_backlog(db.logs, 'job', size=6)
+    assert not has_backlog(db.logs, 'job', size=7)
+    with claim_batch(db.logs, 'job', max_size=2):
+        pass
+    assert has_backlog(db.logs, 'job', size=4)
+    assert not has_backlog(db.logs, 'job', size=5)
@@ -0,0 +1,33 @@
+import pytest
+
+from dialogic_dashboard.dash_app.search_index import SearchIndex, to_fts_query
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    pytest.importorskip('snowballstemmer')
+    return str(tmp_path / 'index.sqlite')
+
+
+def test_russian_words_match_by_stem(db, logs, index_path):
+    logs.turn('s1', 'help', '2021-01-01 00:00', text='Какие программы есть?')
+    logs.turn('s2', 'help', '2021-01-01 00:01', text='Покажи программу передач')
+    index = SearchIndex(index_path, language='russian')
+    assert index.update(db.logs) == 4
+    found = {hit['request_id'] for hit in index.search('программа')}
+    assert found == {'s1-0', 's2-2'}
+    assert [hit['request_id'] for hit in index.search('"программу передачи"')] == ['s2-2']
+    assert {hit['request_id'] for hit in index.search('Прогр*')} == {'s1-0', 's2-2'}
+
+
+def test_an_unstemmed_index_is_rebuilt(db, logs, index_path):
+    logs.turn('s1', 'help', '2021-01-01 00:00', text='программы')
+    SearchIndex(index_path, language='none').update(db.logs)
+    index = SearchIndex(index_path, language='russian')
+    assert index.search('программа') == []
+    index.update(db.logs)
+    assert len(index.search('программа')) == 1
+
+
+def test_to_fts_query_without_stemming():
+    assert to_fts_query('Hello "big world" wor*') == '"Hello" "big world" "wor"*'
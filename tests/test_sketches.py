@@ -0,0 +1,42 @@
+import random
+
+from collections import Counter
+
+from dialogic_dashboard.dash_app.sketches import space_saving_update
+
+
+def feed(stream, k, batch_size):
+    top = []
+    for start in range(0, len(stream), batch_size):
+        counts = Counter(stream[start:start + batch_size])
+        top = space_saving_update(top, {key: {'count': c} for key, c in counts.items()}, k)
+    return top
+
+
+def test_space_saving_is_exact_when_all_keys_fit():
+    stream = ['a'] * 5 + ['b'] * 3 + ['c']
+    top = feed(stream, k=3, batch_size=4)
+    assert [(i['key'], i['count'], i['error']) for i in top] == [('a', 5, 0), ('b', 3, 0), ('c', 1, 0)]
+
+
+def test_space_saving_error_bounds():
+    rng = random.Random(0)
+    # a few frequent keys among many rare ones
+    stream = [f'k{min(int(rng.paretovariate(1.2)), 500)}' for _ in range(5000)]
+    rng.shuffle(stream)
+    true = Counter(stream)
+    k = 20
+    top = feed(stream, k=k, batch_size=300)
+    assert len(top) == k
+    for item in top:
+        # the count is an overestimate by at most its error
+        assert item['count'] - item['error'] <= true[item['key']] <= item['count']
+    # every key more frequent than N/k is kept
+    kept = {item['key'] for item in top}
+    assert {key for key, c in true.items() if c > len(stream) / k} <= kept
+
+
+def test_space_saving_keeps_the_time_range():
+    top = space_saving_update([], {'a': {'count': 1, 'first_time': '2021-01-02', 'last_time': '2021-01-02'}}, 2)
+    top = space_saving_update(top, {'a': {'count': 2, 'first_time': '2021-01-01', 'last_time': '2021-01-03'}}, 2)
+    assert top == [{'key': 'a', 'count': 3, 'error': 0, 'first_time': '2021-01-01', 'last_time': '2021-01-03'}]